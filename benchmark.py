@@ -0,0 +1,293 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import main as analyzer
+
+#
+# Benchmarks for the analysis pipeline.
+#
+
+def random_graph(N: int, degree: int, cycle_rate: float, rng: random.Random) -> list:
+    # Include graphs are mostly layered: headers include headers "below" them. Every node gets up to
+    # `degree` edges to later nodes and with probability cycle_rate one edge back to an earlier node.
+    adjacency = []
+    for i in range(N):
+        successors = set()
+        if i + 1 < N:
+            for _ in range(degree):
+                # favor nearby nodes, like headers within the same component
+                successors.add(min(N - 1, i + 1 + int(rng.expovariate(1 / 50))))
+        if i > 0 and rng.random() < cycle_rate:
+            successors.add(rng.randrange(i))
+        adjacency.append(sorted(successors))
+    return adjacency
+
+def benchmark_closure(sizes: list, degree: int, cycle_rate: float, seed: int):
+    rng = random.Random(seed)
+    print("{:>8} {:>10} {:>12} {:>14}".format("nodes", "edges", "seconds", "closure edges"))
+    for N in sizes:
+        adjacency = random_graph(N, degree, cycle_rate, rng)
+        start = time.perf_counter()
+        rows = analyzer.transitive_closure(adjacency)
+        elapsed = time.perf_counter() - start
+        print("{:>8} {:>10} {:>12.3f} {:>14}".format(
+            N,
+            sum(len(successors) for successors in adjacency),
+            elapsed,
+            sum(row.bit_count() for row in rows)
+        ))
+
+# Pipeline benchmark
+# generate_tree writes a synthetic project: headers spread over `search_paths` include directories
+# and arranged in `depth` layers, every file including `fanout` files from the layers below it and,
+# with probability cycle_rate, one from the layers above. benchmark_pipeline then times every stage
+# of an analysis of it separately.
+
+filler = [
+    "// a line comment with some words in it\n",
+    "/* a block comment\n * spanning lines\n */\n",
+    "static const char* s{n} = \"a string with \\\"escapes\\\" and // no comment\";\n",
+    "int function{n}(int a, int b) {{\n    return a * {n} + b / 3 - (a << 2);\n}}\n",
+    "#define MACRO{n}(x) \\\n    ((x) + {n})\n",
+    "struct S{n} {{ int a; float b; char c[{n}]; }};\n"
+]
+
+def filler_text(size: int, rng: random.Random) -> str:
+    parts = []
+    length = 0
+    while length < size:
+        part = rng.choice(filler).format(n=rng.randrange(1000))
+        parts.append(part)
+        length += len(part)
+    if rng.random() < 0.05:
+        parts.append("/* trigraphs ??- ??! */\n")
+    return "".join(parts)
+
+def generate_tree(root: str, files: int, file_size: int, fanout: int, depth: int, cycle_rate: float,
+                  search_paths: int, tus: int, seed: int) -> str:
+    # returns the path of the generated compile_commands.json
+    rng = random.Random(seed)
+    headers = ["mod{}/h{}.h".format(i % 16, i) for i in range(files)]
+    directories = [os.path.join(root, "include", "p{}".format(k)) for k in range(search_paths)]
+    layers = [i * depth // max(files, 1) for i in range(files)]
+    # first index of each layer, files include files from later layers
+    starts = {}
+    for i, layer in enumerate(layers):
+        starts.setdefault(layer, i)
+    def includes(candidates: range, earlier: range) -> str:
+        chosen = rng.sample(candidates, min(len(candidates), fanout)) if len(candidates) > 0 else []
+        if len(earlier) > 0 and rng.random() < cycle_rate:
+            chosen.append(rng.choice(earlier))
+        lines = []
+        for j in chosen:
+            lines.append("#include \"{}\"\n".format(headers[j]) if rng.random() < 0.5 else "#include <{}>\n".format(headers[j]))
+        return "".join(lines)
+    for i, header in enumerate(headers):
+        path = os.path.join(directories[i % search_paths], header)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        below = range(starts.get(layers[i] + 1, files), files)
+        guard = "H{}_H".format(i)
+        with open(path, "w") as f:
+            f.write("#ifndef {0}\n#define {0}\n".format(guard))
+            f.write(includes(below, range(0, starts[layers[i]])))
+            f.write(filler_text(file_size, rng))
+            f.write("#endif\n")
+    os.makedirs(os.path.join(root, "src"), exist_ok=True)
+    flags = " ".join("-Iinclude/p{}".format(k) for k in range(search_paths))
+    compile_commands = []
+    top = range(0, starts.get(1, files))
+    for t in range(tus):
+        source = "src/t{}.c".format(t)
+        with open(os.path.join(root, source), "w") as f:
+            f.write(includes(top, range(0)))
+            f.write(filler_text(file_size, rng))
+        compile_commands.append({
+            "directory": root,
+            "file": source,
+            "command": "cc {} -c {}".format(flags, source)
+        })
+    path = os.path.join(root, "compile_commands.json")
+    with open(path, "w") as f:
+        json.dump(compile_commands, f, indent=1)
+    return path
+
+def timed(stages: dict, name: str, repeat: int, function, *args):
+    # records the best of `repeat` runs of function and returns its last result
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    stages[name] = best
+    print("{:>24} {:>10.3f}".format(name, best), file=sys.stderr)
+    return result
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True
+        ).stdout.strip() or None
+    except OSError:
+        return None
+
+def benchmark_pipeline(compile_commands: str, repeat: int) -> dict:
+    # the analyzer prints its progress, that goes to /dev/null while stages are timed
+    stages = {}
+    devnull = open(os.devnull, "w")
+    with contextlib.redirect_stdout(devnull):
+        entries = analyzer.load_compile_commands(compile_commands)
+        files = []
+        for directory, _, names in os.walk(os.path.dirname(compile_commands)):
+            files += [os.path.join(directory, name) for name in sorted(names) if name.endswith((".c", ".h"))]
+        def read_files():
+            contents = []
+            for path in files:
+                with open(path, "r") as f:
+                    contents.append(f.read())
+            return contents
+        contents = timed(stages, "read", repeat, read_files)
+        timed(stages, "phase_one", repeat, lambda: [analyzer.phase_one(content) for content in contents])
+        spliced = timed(stages, "phase_two", repeat, lambda: [analyzer.phase_two(content) for content in contents])
+        timed(stages, "phase_three", repeat, lambda: [sum(1 for _ in analyzer.phase_three(content)) for content in spliced])
+        timed(stages, "parse_includes", repeat, lambda: [analyzer.parse_includes(path) for path in files])
+        parsed = timed(stages, "scan_includes", repeat, lambda: {path: analyzer.scan_includes(path) for path in files})
+        # traversal with parsing taken out, it reads the include lists parsed above
+        def traverse():
+            analysis = analyzer.Analysis([], [], parsed.__getitem__)
+            for path, search_paths, defines in entries:
+                analysis.process_translation_unit(path, search_paths, defines)
+            return analysis
+        analysis = timed(stages, "traversal", repeat, traverse)
+        lookups = [
+            (path, include, search_paths)
+            for path in analysis.visited
+            for search_paths, _ in analysis.file_contexts[path]
+            for include in parsed[path]["includes"]
+        ]
+        def resolve():
+            resolver = analyzer.Analysis([], [], parsed.__getitem__)
+            for path, include, search_paths in lookups:
+                resolver.resolve_include(path, include, search_paths)
+        timed(stages, "resolve_include", repeat, resolve)
+        timed(stages, "build_matrix", repeat, analysis.build_matrix)
+        timed(stages, "statistics", repeat, lambda: analyzer.Statistics(analysis.graph, analysis.closure, analysis.is_tu))
+        analysis.statistics()
+        def costs():
+            analysis.cost_model = None
+            return analysis.costs()
+        timed(stages, "costs", repeat, costs)
+        timed(stages, "write_text", repeat, analyzer.write_text, analysis, {"nodes", "matrix", "counts"}, devnull)
+        timed(stages, "write_graphviz", repeat, analyzer.write_text, analysis, {"graphviz"}, devnull)
+        timed(stages, "write_graphviz_reduced", repeat, analyzer.write_text, analysis, {"graphviz"}, devnull, True)
+        timed(stages, "write_json", repeat, analyzer.write_json, analysis, {"nodes", "edges", "closure", "counts"}, devnull)
+        timed(stages, "write_ndjson", repeat, analyzer.write_ndjson, analysis, {"nodes", "edges", "closure", "counts"}, devnull)
+    devnull.close()
+    return {
+        "commit": git_commit(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "files": len(files),
+        "bytes": sum(len(content) for content in contents),
+        "translation_units": len(entries),
+        "nodes": len(analysis.nodes),
+        "edges": analysis.graph.edge_count(),
+        "closure_edges": analysis.closure.edge_count(),
+        "stages": stages
+    }
+
+def compare_results(results: dict, baseline: dict):
+    # regressions of more than 10% are marked
+    print("{:>24} {:>10} {:>10} {:>8}".format("stage", "baseline", "current", "change"))
+    for name, seconds in results["stages"].items():
+        if name not in baseline["stages"]:
+            continue
+        before = baseline["stages"][name]
+        change = (seconds - before) / before if before > 0 else 0
+        print("{:>24} {:>10.3f} {:>10.3f} {:>+7.0%}{}".format(name, before, seconds, change, " !" if change > 0.1 else ""))
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="benchmark",
+        description="Benchmarks for cpp-dependency-analyzer"
+    )
+    parser.add_argument("--sizes", type=str, default="1000,5000,10000,50000")
+    parser.add_argument("--degree", type=int, default=10)
+    parser.add_argument("--cycle-rate", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="benchmark every stage of an analysis of a synthetic project instead of only the closure"
+    )
+    parser.add_argument("--files", type=int, default=2000, help="number of headers to generate")
+    parser.add_argument("--file-size", type=int, default=4000, help="approximate size of every file in bytes")
+    parser.add_argument("--fanout", type=int, default=6, help="number of includes in every file")
+    parser.add_argument("--depth", type=int, default=8, help="number of layers headers are arranged in")
+    parser.add_argument("--search-paths", type=int, default=4, help="number of -I directories headers are spread over")
+    parser.add_argument("--tus", type=int, default=200, help="number of translation units")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per stage, the fastest one is recorded")
+    parser.add_argument(
+        "--tree",
+        type=str,
+        help="generate the project into this directory and keep it, otherwise a temporary directory is used"
+    )
+    parser.add_argument(
+        "--generate-only",
+        action="store_true",
+        help="only generate the project into --tree"
+    )
+    parser.add_argument("--results", type=str, help="write the pipeline results as json to this file")
+    parser.add_argument("--compare", type=str, help="compare the pipeline results to these earlier results")
+    args = parser.parse_args()
+    if args.pipeline or args.generate_only:
+        if args.generate_only and args.tree is None:
+            raise RuntimeError("--generate-only requires --tree")
+        root = os.path.abspath(args.tree) if args.tree is not None else tempfile.mkdtemp(prefix="cpp-dependency-analyzer-")
+        try:
+            compile_commands = generate_tree(
+                root, args.files, args.file_size, args.fanout, args.depth, args.cycle_rate, args.search_paths,
+                args.tus, args.seed
+            )
+            if args.generate_only:
+                print(compile_commands)
+                return
+            results = benchmark_pipeline(compile_commands, args.repeat)
+        finally:
+            if args.tree is None:
+                shutil.rmtree(root)
+        results["parameters"] = {
+            "files": args.files,
+            "file_size": args.file_size,
+            "fanout": args.fanout,
+            "depth": args.depth,
+            "cycle_rate": args.cycle_rate,
+            "search_paths": args.search_paths,
+            "tus": args.tus,
+            "seed": args.seed
+        }
+        if args.results is not None:
+            with open(args.results, "w") as f:
+                json.dump(results, f, indent=4)
+        if args.compare is not None:
+            with open(args.compare, "r") as f:
+                compare_results(results, json.load(f))
+        else:
+            print(json.dumps(results, indent=4))
+        return
+    benchmark_closure([int(size) for size in args.sizes.split(",")], args.degree, args.cycle_rate, args.seed)
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,41 @@
 import argparse
+import array
+import collections
 import colorama
+import codecs
+import concurrent.futures
+import contextlib
+import functools
+import gzip
+import heapq
+import itertools
 from enum import Enum
+import hashlib
 import os
 import re
+import selectors
+import shlex
+import socket
+import sqlite3
 import sys
+import time
 import json
 import math
+import mmap
 
 #
 # This is a tool to analyze dependencies within a codebase.
 # This code does the absolute bare-minimum C parsing in order to understand include directives.
-# No macros are expanded and no conditionals are evaluated.
+# By default no macros are expanded and no conditionals are evaluated. With --conditionals simple
+# #if/#ifdef/#elif expressions are evaluated against the platform's macros and each compile command's
+# -D/-U flags, and includes in branches which are known to be dead aren't followed.
 # There are better and more optimal ways to implement this all, however, it does it's job! And it
 # does it well (at least for small codebases). Not a whole lot of value in optimizing an
 # inconsequential script.
 #
 # Includes will form a dependency graph (usually a DAG but not necessarily) and this graph is
-# traversed depth-first. No include guards are evaluated but cycles are avoided.
+# traversed depth-first. Include guards and #pragma once are detected when a file is parsed but not
+# needed for the traversal, which visits each file once per context and avoids cycles anyway.
 #
 # At the moment escape sequences in path-specs are not evaluated.
 #
@@ -41,43 +60,32 @@ Trigraph_translation_table = {
     ">": "}",
     "-": "~"
 }
+trigraph_regex = re.compile(r"\?\?([=/'()!<>\-])")
 def phase_one(string):
     # trigraphs
-    i = 0
-    translated_string = ""
-    while i < len(string):
-        if string[i] == "?" and i < len(string) - 2 and string[i + 1] == "?" and string[i + 2] in Trigraph_translation_table:
-            translated_string += Trigraph_translation_table[string[i + 2]]
-            i += 3
-        else:
-            translated_string += string[i]
-            i += 1
-    return translated_string
+    return trigraph_regex.sub(lambda m: Trigraph_translation_table[m.group(1)], string)
+
+# a logical line made up of one or more physical lines ending in a backslash
+line_splice_regex = re.compile(r"^(?:[^\n]*\\\n)+[^\n]*(\n?)", re.M)
+def splice_lines(m):
+    # this is a really dirty way of taking care of line number errors for backslash + \n sequences:
+    # the removed newlines are added back after the logical line
+    lines = m.group()
+    spliced = lines.replace("\\\n", "")
+    if m.group(1):
+        return spliced + "\n" * lines.count("\\\n")
+    else:
+        return spliced
 
 def phase_two(string):
     # backslash followed immediately by newline
-    i = 0
-    translated_string = ""
-    # this is a really dirty way of taking care of line number errors for backslash + \n sequences
-    line_debt = 0
-    while i < len(string):
-        if string[i] == "\\" and i < len(string) - 1 and string[i + 1] == "\n":
-            i += 2
-            line_debt += 1
-        elif string[i] == "\n":
-            translated_string += "\n" * (1 + line_debt)
-            line_debt = 0
-            i += 1
-        else:
-            translated_string += string[i]
-            i += 1
-    return translated_string
+    return line_splice_regex.sub(splice_lines, string)
 
 # lexer rules
 lexer_rules = [
     ("COMMENT", r"//.*(?=\n|$)"),
-    ("MCOMMENT", r"/\*(?:(?!\*/)[\s\S])*\*/"), #r"/\*(?s:.)*\*/"),
-    ("RAW_STRING", r"(R\"([^ ()\t\r\v\n]*)\((?P<RAW_STRING_CONTENT>(?:(?!\)\5\").)*)\)\5\")"),
+    ("MCOMMENT", r"/\*[\s\S]*?\*/"),
+    ("RAW_STRING", r"((?:u8|[uUL])?R\"([^ ()\t\r\v\n]*)\((?P<RAW_STRING_CONTENT>(?:(?!\)\5\")[\s\S])*)\)\5\")"),
     ("IDENTIFIER", r"[a-zA-Z_$][a-zA-Z0-9_$]*"),
     ("NUMBER", r"[0-9]([eEpP][\-+]?[0-9a-zA-Z.']|[0-9a-zA-Z.'])*"), # basically a ppnumber regex # r"(?:0x|0b)?[0-9a-fA-F]+(?:.[0-9a-fA-F]+)?(?:[eEpP][0-9a-fA-F]+)?(?:u|U|l|L|ul|UL|ll|LL|ull|ULL|f|F)?",
     ("STRING", r"\"(?P<STRING_CONTENT>(?:\\x[0-7]+|\\.|[^\"\\])*)\""),
@@ -90,6 +98,7 @@ lexer_rules = [
 lexer_ignores = {"COMMENT", "MCOMMENT", "WHITESPACE"}
 lexer_regex = ""
 class Token:
+    __slots__ = ("token_type", "value", "line", "pos")
     def __init__(self, token_type, value, line, pos):
         self.token_type = token_type
         self.value = value
@@ -97,7 +106,8 @@ class Token:
         self.pos = pos
         # only digraph that needs to be handled
         if token_type == "PREPROCESSING_DIRECTIVE":
-            self.value = re.sub(r"^%:", "#", value)
+            if value.startswith("%:"):
+                self.value = "#" + value[2:]
         elif token_type == "NEWLINE":
             self.value = ""
     def __repr__(self):
@@ -117,39 +127,63 @@ def init_lexer():
 init_lexer()
 
 def phase_three(string):
-    # tokenization
-    tokens = []
+    # tokenization, tokens are generated lazily as the parser consumes them
     i = 0
     line = 1
+    match = lexer_regex.match
     while True:
         if i >= len(string):
             break
-        m = lexer_regex.match(string, i)
+        m = match(string, i)
         if m:
             groupname = m.lastgroup
             if groupname not in lexer_ignores:
                 if groupname == "STRING":
-                    tokens.append(Token(groupname, m.group("STRING_CONTENT"), line, i))
+                    yield Token(groupname, m.group("STRING_CONTENT"), line, i)
                 elif groupname == "RAW_STRING":
-                    tokens.append(Token(groupname, m.group("RAW_STRING_CONTENT"), line, i))
+                    yield Token(groupname, m.group("RAW_STRING_CONTENT"), line, i)
                 else:
-                    tokens.append(Token(groupname, m.group(groupname), line, i))
+                    yield Token(groupname, m.group(groupname), line, i)
             if groupname == "NEWLINE":
                 line += 1
-            if groupname == "MCOMMENT":
+            if groupname in ("MCOMMENT", "RAW_STRING"):
+                # raw strings can span lines too
                 line += m.group(groupname).count("\n")
             i = m.end()
         else:
-            print(string)
             print(i)
-            print(tokens)
             print(line)
             print("\n\n{}\n\n".format(string[i-5:i+20]))
             raise Exception("lexer error")
     # TODO ensure there's always a newline token at the end?
-    return tokens
+
+class TokenStream:
+    # cursor over the phase three token generator, only buffers as many tokens as the parser peeks
+    __slots__ = ("tokens", "buffer", "count")
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.buffer = collections.deque()
+        self.count = 0 # tokens taken from the generator so far
+    def peek(self, n: int):
+        # returns up to n upcoming tokens without consuming them
+        while len(self.buffer) < n:
+            token = next(self.tokens, None)
+            if token is None:
+                break
+            self.count += 1
+            self.buffer.append(token)
+        return self.buffer
+    def pop(self):
+        if self.buffer:
+            return self.buffer.popleft()
+        token = next(self.tokens)
+        self.count += 1
+        return token
+    def __bool__(self):
+        return len(self.peek(1)) > 0
 
 def peek_tokens(tokens, seq):
+    tokens = tokens.peek(len(seq))
     if len(tokens) < len(seq):
         return False
     for i, token in enumerate(seq):
@@ -161,6 +195,7 @@ def peek_tokens(tokens, seq):
     return True
 
 def expect(tokens, seq, line, after, expected=None):
+    tokens = tokens.peek(len(seq))
     good = True
     reason = ""
     if len(tokens) < len(seq):
@@ -183,16 +218,160 @@ def expect(tokens, seq, line, after, expected=None):
         else:
             raise Exception("parse error: unexpected tokens following {} on line {}, failed due to {}".format(after, line, reason))
 
-def parse_includes(path: str) -> list:
-    # get file contents
-    with open(path, "r") as f:
-        content = f.read()
+# Encodings tried in order when decoding source files, the first one which works is used. With
+# latin-1 last decoding never fails since every byte is a valid latin-1 character.
+source_encodings = ["utf-8", "latin-1"]
+
+def decode_source(data: bytes, path: str) -> str:
+    for encoding in source_encodings:
+        try:
+            return data.decode(encoding)
+        except UnicodeDecodeError:
+            pass
+    raise Exception("can't decode {} with any of the encodings {}".format(path, ", ".join(source_encodings)))
+
+def prepare_source(content: str) -> str:
+    # newlines like text mode reads them
+    if "\r" in content:
+        content = content.replace("\r\n", "\n").replace("\r", "\n")
     # trigraphs
-    content = phase_one(content)
+    if "??" in content:
+        content = phase_one(content)
     # backslash newline
-    content = phase_two(content)
+    if "\\\n" in content:
+        content = phase_two(content)
+    return content
+
+def read_source(path: str) -> str:
+    # get file contents
+    with open(path, "rb") as f:
+        return prepare_source(decode_source(f.read(), path))
+
+def count_lines(content) -> int:
+    # content is a str, bytes or a mmap, a last line without newline counts too
+    newline = "\n" if isinstance(content, str) else b"\n"
+    if isinstance(content, mmap.mmap):
+        lines = sum(content[i : i + (1 << 20)].count(newline) for i in range(0, len(content), 1 << 20))
+    else:
+        lines = content.count(newline)
+    return lines + (1 if len(content) > 0 and content[-1:] != newline else 0)
+
+# Conditional directives
+# Besides #include both parsers record #if/#ifdef/#ifndef/#elif/#elifdef/#elifndef/#else/#endif,
+# #define, #undef and #pragma as (line, kind, text), text being the rest of the line after the
+# directive name as written. It's only tokenized by directive_argument when the file's conditionals
+# have to be evaluated, most files only have an include guard and their #defines are never looked at.
+conditional_directives = ("if", "ifdef", "ifndef", "elif", "elifdef", "elifndef", "else", "endif", "define", "undef", "pragma")
+opening_directives = ("if", "ifdef", "ifndef")
+directive_token_regex = re.compile(r"""\s+|//[^\n]*|/\*[\s\S]*?\*/|(?P<TOKEN>"(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*'|[a-zA-Z_$][a-zA-Z0-9_$]*|\.?[0-9](?:[eEpP][-+]|[0-9a-zA-Z_.'])*|&&|\|\||<<|>>|[<>=!]=|##|\S)""")
+
+def directive_argument(kind: str, text: str):
+    # The argument of a directive as tokens joined by single spaces, without comments. For #define
+    # it's (name, replacement), the replacement being None for function-like macros.
+    tokens = []
+    name_end = None
+    for m in directive_token_regex.finditer(text):
+        token = m.group("TOKEN")
+        if token is not None:
+            tokens.append(token)
+            if name_end is None:
+                name_end = m.end()
+    if kind == "define":
+        if not tokens:
+            return "", ""
+        # a parenthesis right after the name, without whitespace or comments, makes it function-like
+        function_like = text[name_end : name_end + 1] == "("
+        return tokens[0], None if function_like else " ".join(tokens[1:])
+    if kind in ("if", "elif", "pragma"):
+        return " ".join(tokens)
+    if kind in ("else", "endif"):
+        return ""
+    return tokens[0] if tokens else ""
+
+# Parse functions (parse_includes, scan_includes, verify_scan) take a path and return a dict with the
+# file's includes, its size in bytes, lines and tokens (None for the scanner, which doesn't tokenize),
+# its include guard and the directive skeleton used to evaluate conditionals. The metrics feed the
+# cost model.
+def source_info(directives: list, size: int, lines: int, tokens: int = None) -> dict:
+    includes = []
+    conditional = False
+    pragma_once = False
+    for _, kind, text in directives:
+        if kind == "include":
+            includes.append(text)
+        elif kind == "pragma":
+            pragma_once = pragma_once or directive_argument(kind, text) == "once"
+        elif kind not in ("define", "undef"):
+            conditional = True
+    directives = [directive for directive in directives if directive[1] != "pragma"]
+    guard = include_guard(directives) if conditional else None
+    skeleton = None # [kind, argument] per directive, [include, index into includes] for includes
+    # without conditionals besides the include guard every include is active in every context
+    if conditional and (guard is None or sum(kind in opening_directives for _, kind, _ in directives) > 1):
+        skeleton = []
+        k = 0
+        for _, kind, text in directives:
+            if kind == "include":
+                skeleton.append(["include", k])
+                k += 1
+            elif kind == "define":
+                skeleton.append(["define", *directive_argument(kind, text)])
+            else:
+                skeleton.append([kind, directive_argument(kind, text)])
+    return {
+        "includes": includes,
+        "size": size,
+        "lines": lines,
+        "tokens": tokens,
+        "skeleton": skeleton,
+        "guard": guard,
+        "pragma_once": pragma_once
+    }
+
+def include_guard(directives: list):
+    # The guard macro if the directives are an include guard around everything else: #ifndef X or
+    # #if !defined X first, #define X second and the matching #endif last. Code outside of the guard
+    # isn't seen by the scanner, so only directives are checked.
+    if len(directives) < 3 or directives[1][1] != "define" or directives[-1][1] != "endif":
+        return None
+    _, kind, text = directives[0]
+    condition = directive_argument(kind, text)
+    if kind == "ifndef":
+        name = condition
+    elif kind == "if" and re.fullmatch(r"! defined (?:\( )?[a-zA-Z_$][a-zA-Z0-9_$]*(?: \))?", condition):
+        name = condition.split(" ")[-2 if condition.endswith(")") else -1]
+    else:
+        return None
+    if directive_argument("define", directives[1][2])[0] != name:
+        return None
+    depth = 0
+    for k, (_, kind, _) in enumerate(directives):
+        if kind in opening_directives:
+            depth += 1
+        elif depth == 1 and kind in ("elif", "elifdef", "elifndef", "else"):
+            return None
+        elif kind == "endif":
+            depth -= 1
+            if depth == 0:
+                return name if k == len(directives) - 1 else None
+    return None
+
+def parse_source(path: str) -> tuple:
+    # returns (directives, size, lines, tokens)
+    content = read_source(path)
+    tokens = TokenStream(phase_three(content))
+    directives = parse_include_directives(content, tokens)
+    return directives, os.path.getsize(path), count_lines(content), tokens.count
+
+def parse_includes(path: str) -> dict:
+    return source_info(*parse_source(path))
+
+def parse_include_directives(content: str, tokens: TokenStream = None) -> list:
+    # returns a list of (line, "include", path) for every #include in the file, with the conditional
+    # directives in between
     # tokenize
-    tokens = phase_three(content)
+    if tokens is None:
+        tokens = TokenStream(phase_three(content))
 
     # print(tokens)
     # return
@@ -201,23 +380,23 @@ def parse_includes(path: str) -> list:
     # Preprocessor directives are only valid if they are at the beginning of a line. Code makes
     # sure the next token is always at the start of the line going into each loop iteration.
     includes = [] # files queued up to process so that logic doesn't get put in the middle of the parse logic
-    while len(tokens) > 0:
-        token = tokens.pop(0)
+    while tokens:
+        token = tokens.pop()
         if token.token_type == "PREPROCESSING_DIRECTIVE" and token.value == "#include":
             line = token.line
-            if len(tokens) == 0:
+            if not tokens:
                 raise Exception("parse error: expected token following #include directive, found nothing")
             elif peek_tokens(tokens, ("STRING", )):
-                path_token = tokens.pop(0)
+                path_token = tokens.pop()
                 expect(tokens, ("NEWLINE", ), line, "#include declaration")
-                tokens.pop(0) # pop eol
+                tokens.pop() # pop eol
                 print("{} #include \"{}\"".format(line, path_token.value))
                 #process_queue.append(path_token.value)
-                includes.append(path_token.value)
+                includes.append((line, "include", path_token.value))
                 # self.queue_all(process_queue, os.path.join(os.path.dirname(file_path), path_token.value))
             elif peek_tokens(tokens, (("PUNCTUATION", "<"), )):
                 # because tokens can get weird between the angle brackets, the path is extracted from the raw source
-                open_bracket = tokens.pop(0)
+                open_bracket = tokens.pop()
                 i = open_bracket.pos + 1
                 while True:
                     if i >= len(content):
@@ -235,10 +414,10 @@ def parse_includes(path: str) -> list:
                 path = content[open_bracket.pos + 1 : i]
                 # consume tokens up to the closing ">"
                 while True:
-                    if len(tokens) == 0:
+                    if not tokens:
                         # shouldn't happen
                         raise Exception("internal parse error: unexpected eof")
-                    token = tokens.pop(0)
+                    token = tokens.pop()
                     if token.token_type == "PUNCTUATION" and token.value == ">":
                         # exit condition
                         break
@@ -246,194 +425,2727 @@ def parse_includes(path: str) -> list:
                         # shouldn't happen
                         raise Exception("internal parse error: unexpected newline")
                 expect(tokens, ("NEWLINE", ), line, "#include declaration")
-                tokens.pop(0) # pop eol
+                tokens.pop() # pop eol
                 ## # library includes won't be traversed
                 print("{} #include <{}>".format(line, path))
-                includes.append(path)
+                includes.append((line, "include", path))
             elif peek_tokens(tokens, ("IDENTIFIER", )):
-                identifier = tokens.pop(0)
+                identifier = tokens.pop()
                 expect(tokens, ("NEWLINE", ), line, "#include declaration")
                 print("Warning: Ignoring #include {}".format(identifier.value))
             else:
                 raise Exception("parse error: unexpected token sequence after #include directive on line {}. This may be a valid preprocessing directive and reflect a shortcoming of this parser.".format(line))
         else:
+            # other directives are recorded from the raw text of their line
+            kind = None
+            if token.token_type == "PREPROCESSING_DIRECTIVE" and token.value[1:] in conditional_directives:
+                kind = token.value[1:]
+                start = token.pos + len(token.value) + (1 if content.startswith("%:", token.pos) else 0)
+                # the lexer stops at the first character which isn't a lowercase letter
+                if re.match(r"[a-zA-Z0-9_$]", content[start : start + 1]):
+                    kind = None
+            elif token.token_type == "PUNCTUATION" and token.value == "#" and peek_tokens(tokens, ("IDENTIFIER", )):
+                name = tokens.peek(1)[0]
+                if name.value in conditional_directives:
+                    kind = name.value
+                    start = name.pos + len(name.value)
+            line = token.line
             # need to consume the whole line of tokens
-            while token.token_type != "NEWLINE" and len(tokens) > 0:
-                token = tokens.pop(0)
+            while token.token_type != "NEWLINE" and tokens:
+                token = tokens.pop()
+            if kind is not None:
+                end = token.pos if token.token_type == "NEWLINE" else len(content)
+                includes.append((line, kind, content[start:end]))
     return includes
 
-class Analysis:
-    def __init__(self, excludes: list, sentinels: list):
-        self.excludes = excludes
-        self.sentinels = sentinels
-        self.not_found = set()
-        self.visited = set() # set of absolute paths
-        # absolute path -> { i: number, dependencies: list[absolute path]}
-        self.nodes = {}
-        # self.process_file(file_path)
+# Fast directive scanner
+# Instead of tokenizing the whole file this only stops on the constructs which can hide or start a
+# directive: comments, string/char/raw string literals and the beginning of lines. Everything else
+# (function bodies, declarations, ...) is skipped over by the regex engine without producing tokens.
+# Digraphs are handled by the rules below.
+# Files are scanned as bytes (memory mapped when large) with the same rules compiled as byte regexes
+# and only the include paths and the text of other directives are decoded. The byte rules step over
+# line splices and CRLF line endings, directives containing a splice or a trigraph are put through
+# phase one and two on their own.
+# like the parser, comments can separate the # from the name (but not for #include)
+conditional_directive_pattern = r"(?:#(?P<GAP>(?:[^\S\n]|/\*[\s\S]*?\*/)*)|%:)(?P<CONDITIONAL>ifdef|ifndef|if|elifdef|elifndef|elif|else|endif|define|undef|pragma)(?![a-zA-Z0-9_$])"
+# a physical line following a line splice doesn't start a logical line
+logical_line_start = r"^(?<!\\\n)(?<!\\\r\n)"
+scanner_rules = [
+    # PHASED: a line splice or trigraph before the directive's name is left to the str phases
+    ("DIRECTIVE", logical_line_start + r"(?:[^\S\n]*(?:(?:#|%:)include(?![a-z])|" + conditional_directive_pattern + r")|(?=[^\S\n]*(?:\\\r?\n|\?\?=|(?:#|%:)[^\n]*\\\r?\n))(?P<PHASED>))"),
+    # a block comment at the start of a line can be followed by a directive
+    ("BOL_MCOMMENT", logical_line_start + r"[^\S\n]*/\*[\s\S]*?\*/"),
+    ("COMMENT", r"//(?:[^\n]*\\\r?\n)*[^\n]*"),
+    ("MCOMMENT", r"/\*[\s\S]*?\*/"),
+    ("RAW_STRING", r"(?<![a-zA-Z0-9_$])(?:u8|[uUL])?R\"(?P<RAW_DELIMITER>[^ ()\\\t\v\f\n]*)\([\s\S]*?\)(?P=RAW_DELIMITER)\""),
+    ("STRING", r"\"(?:\\\r?\n|\\.|[^\"\\\n])*\""),
+    # only pp-numbers with digit separators matter, otherwise the ' would start a char literal
+    ("NUMBER", r"(?<![a-zA-Z0-9_$])[0-9][0-9a-zA-Z_.]*'[0-9a-zA-Z_.']*"),
+    ("CHAR", r"'(?:\\\r?\n|\\.|[^'\\\n])*'")
+]
+scanner_regex = re.compile("|".join("(?P<{}>{})".format(name, pattern) for name, pattern in scanner_rules), re.M)
+# directive following one or more block comments at the start of a line
+scanner_comment_directive_regex = re.compile(r"(?:[^\S\n]*/\*[\s\S]*?\*/)*[^\S\n]*(?:(?:#|%:)include(?![a-z])|" + conditional_directive_pattern + ")")
+# the remainder of an #include line, comments can appear anywhere whitespace can
+scanner_include_regex = re.compile(r"(?:[^\S\n]|/\*[\s\S]*?\*/)*(?:\"(?P<STRING>(?:\\x[0-7]+|\\.|[^\"\\\n])*)\"|<(?P<ANGLE>[^>\n]*)>|(?P<IDENTIFIER>[a-zA-Z_$][a-zA-Z0-9_$]*))")
+scanner_eol_regex = re.compile(r"(?:[^\S\n]|/\*[\s\S]*?\*/)*(?://[^\n]*)?(?:\n|$)")
+# the rest of any other directive's line, block comments can continue it onto the following lines
+scanner_line_regex = re.compile(r"""(?://(?:[^\n]*\\\r?\n)*[^\n]*|/\*[\s\S]*?\*/|"(?:\\\r?\n|\\.|[^"\\\n])*"|'(?:\\\r?\n|\\.|[^'\\\n])*'|\\\r?\n|[^\n])*""")
+scanner_bytes_regexes = [
+    re.compile(regex.pattern.encode(), regex.flags & re.M)
+    for regex in (scanner_regex, scanner_comment_directive_regex, scanner_include_regex, scanner_eol_regex, scanner_line_regex)
+]
+lone_cr_regex = re.compile(rb"\r(?!\n)")
+# files at least this large are memory mapped instead of read
+mmap_threshold = 1 << 16
 
-    def resolve_include(self, base: str, file_path: str, search_paths: list):
+def decode_include(path: bytes) -> str:
+    for encoding in source_encodings:
+        try:
+            return path.decode(encoding)
+        except UnicodeDecodeError:
+            pass
+    raise Exception("can't decode #include path {!r} with any of the encodings {}".format(path, ", ".join(source_encodings)))
+
+def scan_source(path: str) -> tuple:
+    # returns (directives, size, lines), directives as returned by scan_include_directives
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size >= mmap_threshold:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return scan_bytes(data), size, count_lines(data)
+        data = f.read()
+        return scan_bytes(data), size, count_lines(data)
+
+def decode_latin1_include(path: str) -> str:
+    return decode_include(path.encode("latin-1"))
+
+def scan_phased(data: bytes, line: int) -> list:
+    # latin-1 maps every byte to one character so this copy is lossless and paths can be decoded properly
+    return scan_include_directives(prepare_source(data.decode("latin-1")), decode_latin1_include, line)
+
+def scan_bytes(data) -> list:
+    # Trigraphs that change where a literal ends and lone carriage returns affect the whole file, such
+    # files go through the str phases entirely. Otherwise only directives that need them do.
+    if data.find(b"??/") != -1 or data.find(b"??'") != -1 or (data.find(b"\r") != -1 and lone_cr_regex.search(data)):
+        return scan_phased(data[:], 1)
+    return scan_include_directives(data, decode_include)
+
+def needs_phases(data: bytes) -> bool:
+    return b"\\\n" in data or b"\\\r\n" in data or b"??" in data
+
+def scan_includes(path: str) -> dict:
+    return source_info(*scan_source(path))
+
+def scan_include_directives(content, decode=None, line=1) -> list:
+    # Returns the same list of directives as parse_include_directives. content is a str or bytes-like,
+    # decode turns the paths and directive text found into strs. line is the number of the first line.
+    includes = []
+    if isinstance(content, str):
+        search = scanner_regex.search
+        comment_directive_regex, include_regex, eol_regex, line_regex = scanner_comment_directive_regex, scanner_include_regex, scanner_eol_regex, scanner_line_regex
+        newline = "\n"
+        count = content.count
+        # already through the phases
+        dirty = False
+    else:
+        search = scanner_bytes_regexes[0].search
+        comment_directive_regex, include_regex, eol_regex, line_regex = scanner_bytes_regexes[1:]
+        newline = b"\n"
+        # mmap has no count, newlines are counted in a copy of the range
+        count = content.count if isinstance(content, bytes) else lambda sub, start, end: content[start:end].count(sub)
+        # directives may have to go through the phases
+        dirty = content.find(b"\r") != -1 or content.find(b"\\\n") != -1 or content.find(b"??") != -1
+    i = 0
+    line_pos = 0 # position up to which newlines have been counted
+    while True:
+        m = search(content, i)
+        if m is None:
+            break
+        kind = m.lastgroup
+        start = m.start()
+        i = m.end()
+        if kind == "DIRECTIVE" and m.group("PHASED") is not None:
+            if dirty:
+                line += count(newline, line_pos, start)
+                line_pos = start
+                i = line_regex.match(content, start).end()
+                includes += scan_phased(content[start:i], line)
+            else:
+                # str content has been through the phases already, what is left isn't a directive
+                i = start + 1
+            continue
+        if kind == "BOL_MCOMMENT":
+            m = comment_directive_regex.match(content, i)
+            if m is None:
+                continue
+            i = m.end()
+        elif kind != "DIRECTIVE":
+            continue
+        line += count(newline, line_pos, i)
+        line_pos = i
+        kind = m.group("CONDITIONAL")
+        if kind is not None:
+            directive_line = line
+            gap = m.group("GAP")
+            if gap and newline in gap:
+                # the directive is on the line of its #, a comment after it can span lines
+                directive_line -= gap.count(newline)
+            rest = line_regex.match(content, i)
+            i = rest.end()
+            text = rest.group()
+            if dirty:
+                # a single logical line without trigraphs only needs its physical lines joined
+                joined = text.replace(b"\\\r\n", b"").replace(b"\\\n", b"")
+                if b"\n" in joined or b"??" in joined or needs_phases(content[start:line_pos]):
+                    includes += scan_phased(content[start:i], line - count(newline, start, line_pos))
+                    continue
+                text = joined.replace(b"\r", b"")
+            if decode is not None:
+                includes.append((directive_line, decode(kind), decode(text)))
+            else:
+                includes.append((directive_line, kind, text))
+            continue
+        m = include_regex.match(content, i)
+        eol = None if m is None else eol_regex.match(content, m.end())
+        if dirty:
+            end = line_regex.match(content, start).end() if eol is None else eol.end()
+            if needs_phases(content[start:end]):
+                includes += scan_phased(content[start:end], line - count(newline, start, line_pos))
+                i = end
+                continue
+        if m is None:
+            if not content[i:].strip():
+                raise Exception("parse error: expected token following #include directive, found nothing")
+            raise Exception("parse error: unexpected token sequence after #include directive on line {}. This may be a valid preprocessing directive and reflect a shortcoming of this parser.".format(line))
+        if eol is None:
+            raise Exception("parse error: unexpected tokens following #include declaration on line {}".format(line))
+        i = eol.end()
+        path = m.group(m.lastgroup)
+        if decode is not None:
+            path = decode(path)
+        if m.lastgroup == "STRING":
+            print("{} #include \"{}\"".format(line, path))
+            includes.append((line, "include", path))
+        elif m.lastgroup == "ANGLE":
+            print("{} #include <{}>".format(line, path))
+            includes.append((line, "include", path))
+        else:
+            print("Warning: Ignoring #include {}".format(path))
+    return includes
+
+def verify_scan(path: str) -> dict:
+    # differential check of the fast scanner against the tokenizer-based parser
+    expected = parse_source(path)
+    actual = scan_source(path)
+    if actual[0] != expected[0]:
+        raise Exception("scanner mismatch in {}: parser found {}, scanner found {}".format(path, expected[0], actual[0]))
+    return source_info(*expected)
+
+# Persistent parse cache
+# Parse results only depend on the file contents, the lexer/scanner rules and the parse function, so
+# they are stored in a sqlite database keyed by absolute path and parse function and validated against
+# the file's size and mtime (and optionally a hash of its contents). The parsers don't agree on
+# everything (tokens, some malformed input), so results of one are never served to another. Bump
+# cache_format_version when parsing behavior changes in a way that isn't reflected in the rule tables.
+cache_format_version = 6
+# verify_scan exists to run both parsers on every file, a cached result would skip the check
+uncached_parsers = ("verify_scan", )
+def cache_version() -> str:
+    rules = repr((cache_format_version, lexer_rules, scanner_rules, source_encodings))
+    return hashlib.sha1(rules.encode()).hexdigest()
+
+# Stored results are kept in memory and written in one short transaction at most this often (seconds),
+# so another process using the same cache (a query next to --watch, parallel CI jobs) isn't locked out.
+cache_commit_interval = 1.0
+
+def hash_file(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+class ParseCache:
+    def __init__(self, directory: str, max_entries: int, hash_contents: bool = False):
+        os.makedirs(directory, exist_ok=True)
+        self.max_entries = max_entries
+        self.hash_contents = hash_contents
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.used = [] # paths hit this run, their last_used is updated on close
+        self.stored = [] # rows of results stored since the last write
+        self.db = sqlite3.connect(os.path.join(directory, "parse_cache.sqlite3"))
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        version = self.get_meta("version")
+        if version != cache_version():
+            # lexer rules changed, nothing in the cache can be trusted
+            self.db.execute("DROP TABLE IF EXISTS files")
+            self.set_meta("version", cache_version())
+        self.db.execute("""CREATE TABLE IF NOT EXISTS files (
+            path TEXT,
+            parser TEXT,
+            size INTEGER,
+            mtime INTEGER,
+            hash TEXT,
+            result TEXT,
+            last_used INTEGER,
+            PRIMARY KEY (path, parser)
+        )""")
+        # each run is a generation, eviction drops the entries which haven't been used for the longest
+        self.generation = int(self.get_meta("generation") or 0) + 1
+        self.set_meta("generation", str(self.generation))
+        # writing opened a transaction, other processes couldn't use the cache until it's committed
+        self.db.commit()
+        self.committed = time.monotonic()
+
+    def get_meta(self, key: str):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key, )).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: str):
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def get(self, path: str, parse) -> dict:
+        # returns the cached parse result of parse for path, calling parse(path) on a miss
+        result = self.lookup(path, parse)
+        if result is None:
+            result = parse(path)
+            self.store(path, parse, result)
+        return result
+
+    def lookup(self, path: str, parse):
+        # returns the cached parse result of parse for path or None if there's no valid entry
+        if parse.__name__ in uncached_parsers:
+            return None
+        stat = os.stat(path)
+        row = self.db.execute(
+            "SELECT size, mtime, hash, result FROM files WHERE path = ? AND parser = ?", (path, parse.__name__)
+        ).fetchone()
+        if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            if not self.hash_contents or hash_file(path) == row[2]:
+                self.hits += 1
+                self.used.append((self.generation, path, parse.__name__))
+                return json.loads(row[3])
+        self.misses += 1
+        return None
+
+    def store(self, path: str, parse, result: dict):
+        if parse.__name__ in uncached_parsers:
+            return
+        stat = os.stat(path)
+        content_hash = hash_file(path) if self.hash_contents else None
+        self.stored.append((path, parse.__name__, stat.st_size, stat.st_mtime_ns, content_hash, json.dumps(result), self.generation))
+        if time.monotonic() - self.committed >= cache_commit_interval:
+            self.write_stored()
+            self.db.commit()
+            self.committed = time.monotonic()
+
+    def write_stored(self):
+        self.db.executemany(
+            "INSERT OR REPLACE INTO files (path, parser, size, mtime, hash, result, last_used) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            self.stored
+        )
+        self.stored = []
+
+    def commit(self):
+        self.write_stored()
+        self.db.executemany("UPDATE files SET last_used = ? WHERE path = ? AND parser = ?", self.used)
+        self.used = []
+        count = self.db.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+        if count > self.max_entries:
+            self.evicted = count - self.max_entries
+            self.db.execute(
+                "DELETE FROM files WHERE rowid IN (SELECT rowid FROM files ORDER BY last_used LIMIT ?)",
+                (self.evicted, )
+            )
+        self.db.commit()
+        self.committed = time.monotonic()
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+    def print_stats(self):
+        print("parse cache: {} hits, {} misses, {} evicted".format(self.hits, self.misses, self.evicted))
+
+class IncludeResolver:
+    # Memoizes include resolution, including failed lookups. With index_directories, existence checks
+    # are answered from a cached listing of the containing directory so each directory under a search
+    # path is only read once instead of stat-ing every candidate.
+    def __init__(self, index_directories: bool = False):
+        self.index_directories = index_directories
+        self.memo = {} # (directory, include, search paths) -> (found path or None, candidates checked)
+        self.listings = {} # directory -> set of entries, or None if it can't be listed
+        self.lookups = 0
+        self.memo_hits = 0
+        self.stat_calls = 0
+        self.stat_calls_saved = 0
+        self.listdir_calls = 0
+
+    def list_directory(self, directory: str):
+        if directory not in self.listings:
+            self.listdir_calls += 1
+            try:
+                self.listings[directory] = set(os.listdir(directory or "."))
+            except (FileNotFoundError, NotADirectoryError):
+                # nothing below a missing directory can exist
+                self.listings[directory] = set()
+            except OSError:
+                self.listings[directory] = None
+        return self.listings[directory]
+
+    def exists(self, path: str) -> bool:
+        if self.index_directories:
+            directory, name = os.path.split(path)
+            if name not in ("", ".", ".."):
+                listing = self.list_directory(directory)
+                if listing is not None:
+                    self.stat_calls_saved += 1
+                    return name in listing
+        self.stat_calls += 1
+        return os.path.exists(path)
+
+    def resolve(self, directory: str, file_path: str, search_paths: tuple):
         # search paths: first search relative, then via the paths
+        self.lookups += 1
+        key = (directory, file_path, search_paths)
+        if key in self.memo:
+            found, checked = self.memo[key]
+            self.memo_hits += 1
+            self.stat_calls_saved += checked
+            return found
+        found = None
+        checked = 1
         relative = os.path.join(
-            os.path.dirname(base),
+            directory,
             file_path
         )
-        if os.path.exists(relative):
-            print("        Found:", relative)
-            return os.path.abspath(relative)
+        if self.exists(relative):
+            found = relative
         else:
             for search_path in search_paths:
                 path = os.path.join(
                     search_path,
                     file_path
                 )
-                if os.path.exists(path):
-                    print("        Found:", path)
-                    return os.path.abspath(path)
+                checked += 1
+                if self.exists(path):
+                    found = path
+                    break
+        self.memo[key] = (found, checked)
+        return found
+
+    def clear(self):
+        # forget everything, files may have been created or removed
+        self.memo.clear()
+        self.listings.clear()
+
+    def print_stats(self):
+        print("include resolution: {} lookups, {} memoized, {} stat calls, {} stat calls saved, {} directory listings".format(
+            self.lookups, self.memo_hits, self.stat_calls, self.stat_calls_saved, self.listdir_calls
+        ))
+
+# Transitive closure
+# Reachability rows are python ints used as bitsets, bit j of row i is set if j can be reached from i
+# through one or more edges. The graph is first condensed into its strongly connected components,
+# every node in a component has the same row so rows are only computed once per component.
+def strongly_connected_components(adjacency: list) -> list:
+    # Iterative Tarjan's algorithm. Components are returned in reverse topological order, i.e. every
+    # component comes after all components it has edges to.
+    N = len(adjacency)
+    index = [-1] * N
+    lowlink = [0] * N
+    on_stack = [False] * N
+    stack = []
+    components = []
+    counter = 0
+    for root in range(N):
+        if index[root] != -1:
+            continue
+        index[root] = lowlink[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack[root] = True
+        work = [(root, iter(adjacency[root]))]
+        while work:
+            node, successors = work[-1]
+            descended = False
+            for successor in successors:
+                if index[successor] == -1:
+                    index[successor] = lowlink[successor] = counter
+                    counter += 1
+                    stack.append(successor)
+                    on_stack[successor] = True
+                    work.append((successor, iter(adjacency[successor])))
+                    descended = True
+                    break
+                elif on_stack[successor]:
+                    lowlink[node] = min(lowlink[node], index[successor])
+            if descended:
+                continue
+            work.pop()
+            if work:
+                parent = work[-1][0]
+                lowlink[parent] = min(lowlink[parent], lowlink[node])
+            if lowlink[node] == index[node]:
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack[member] = False
+                    component.append(member)
+                    if member == node:
+                        break
+                components.append(component)
+    return components
+
+def transitive_closure(adjacency: list) -> list:
+    # returns one reachability bitset per node, identical to the floyd-warshall closure: the diagonal
+    # is set for nodes which are part of a cycle
+    rows = [0] * len(adjacency)
+    update_closure_rows(adjacency, rows, range(len(adjacency)))
+    return rows
+
+def update_closure_rows(adjacency: list, rows: list, nodes):
+    # Computes the rows of the given nodes in place. This is used both for the full closure and for
+    # incremental updates: the rows of all other nodes have to be correct already, so nodes has to
+    # contain every node which can reach one of them.
+    nodes = list(nodes)
+    if len(nodes) == len(adjacency):
+        local = None
+        local_adjacency = adjacency
+    else:
+        local = {node: k for k, node in enumerate(nodes)}
+        local_adjacency = [[local[s] for s in adjacency[node] if s in local] for node in nodes]
+    components = strongly_connected_components(local_adjacency)
+    component_of = [0] * len(nodes)
+    for c, component in enumerate(components):
+        for k in component:
+            component_of[k] = c
+    masks = []
+    reach = []
+    for c, component in enumerate(components):
+        mask = 0
+        for k in component:
+            mask |= 1 << nodes[k]
+        successors = set()
+        row = 0
+        cyclic = len(component) > 1
+        for k in component:
+            node = nodes[k]
+            for successor in adjacency[node]:
+                if successor == node:
+                    cyclic = True
+                if local is None:
+                    successors.add(component_of[successor])
+                elif successor in local:
+                    successors.add(component_of[local[successor]])
+                else:
+                    # outside of the updated set, its row is final
+                    row |= (1 << successor) | rows[successor]
+        successors.discard(c)
+        if cyclic:
+            row |= mask
+        # successor components were all completed earlier
+        for s in successors:
+            row |= masks[s] | reach[s]
+        masks.append(mask)
+        reach.append(row)
+    for k, node in enumerate(nodes):
+        rows[node] = reach[component_of[k]]
+
+def bitset_to_list(bits: int, N: int) -> list:
+    return [int(b) for b in reversed(format(bits, "0{}b".format(N)))] if N > 0 else []
+
+def iter_bits(bits: int):
+    # indices of the set bits, in increasing order
+    s = format(bits, "b")[::-1]
+    i = s.find("1")
+    while i != -1:
+        yield i
+        i = s.find("1", i + 1)
+
+class Graph:
+    # Compact adjacency in CSR form: the successors of node i are targets[offsets[i]:offsets[i + 1]],
+    # sorted in increasing order. Iterating yields the successors of each node in turn.
+    __slots__ = ("offsets", "targets")
+    def __init__(self, adjacency: list):
+        self.offsets = array.array("l", [0])
+        self.targets = array.array("l")
+        for successors in adjacency:
+            self.targets.extend(sorted(successors))
+            self.offsets.append(len(self.targets))
+    def __len__(self):
+        return len(self.offsets) - 1
+    def __getitem__(self, i: int):
+        return self.targets[self.offsets[i] : self.offsets[i + 1]]
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+    def edge_count(self) -> int:
+        return len(self.targets)
+    def edges(self):
+        for i in range(len(self)):
+            for j in self[i]:
+                yield i, j
+    def update(self, rows: dict):
+        # replaces the successors of the nodes in rows (node -> successors), nodes past the end are added
+        N = max(len(self), max(rows, default=-1) + 1)
+        self.__init__([rows[i] if i in rows else self[i] for i in range(N)])
+    def dense(self) -> list:
+        N = len(self)
+        matrix = [[0] * N for _ in range(N)]
+        for i, j in self.edges():
+            matrix[i][j] = 1
+        return matrix
+
+class Closure:
+    # Reachability rows as bitsets, see transitive_closure. Iterating yields the reachable nodes of
+    # each node in turn.
+    __slots__ = ("rows", )
+    def __init__(self, rows: list):
+        self.rows = rows
+    def __len__(self):
+        return len(self.rows)
+    def __iter__(self):
+        for row in self.rows:
+            yield iter_bits(row)
+    def row(self, i: int) -> int:
+        return self.rows[i]
+    def contains(self, i: int, j: int) -> bool:
+        return (self.rows[i] >> j) & 1 == 1
+    def edge_count(self) -> int:
+        return sum(row.bit_count() for row in self.rows)
+    def update(self, graph: Graph, nodes) -> dict:
+        # Recomputes the rows after the successors of nodes changed. Only nodes which can reach one of
+        # them are affected. Returns node -> old row for every row that changed.
+        nodes = set(nodes)
+        self.rows.extend([0] * (len(graph) - len(self.rows)))
+        mask = 0
+        for node in nodes:
+            mask |= 1 << node
+        affected = [i for i, row in enumerate(self.rows) if i in nodes or row & mask]
+        old = {i: self.rows[i] for i in affected}
+        update_closure_rows(graph, self.rows, affected)
+        return {i: row for i, row in old.items() if self.rows[i] != row}
+    def dense(self) -> list:
+        return [bitset_to_list(row, len(self.rows)) for row in self.rows]
+
+class LazyClosure:
+    # The same interface as Closure, but rows are computed when they're asked for and kept in a least
+    # recently used cache of at most max_bytes, so memory stays bounded however large the graph is.
+    # Only the condensation of the graph is stored. A row is a depth-first search over the
+    # condensation from the node's component, components whose row is cached aren't searched again.
+    def __init__(self, graph: Graph, max_bytes: int):
+        self.graph = graph
+        self.max_bytes = max_bytes
+        self.cache = collections.OrderedDict() # component -> row
+        self.cached_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.condense()
+
+    def condense(self):
+        graph = self.graph
+        self.components = strongly_connected_components(graph)
+        self.component_of = array.array("l", bytes(len(graph) * array.array("l").itemsize))
+        for c, component in enumerate(self.components):
+            for node in component:
+                self.component_of[node] = c
+        self.successors = [] # component -> successor components
+        self.cyclic = []
+        for c, component in enumerate(self.components):
+            successors = {self.component_of[j] for i in component for j in graph[i]}
+            self.cyclic.append(len(component) > 1 or c in successors)
+            successors.discard(c)
+            self.successors.append(list(successors))
+        self.cache.clear()
+        self.cached_bytes = 0
+
+    def component_row(self, c: int) -> int:
+        row = self.cache.get(c)
+        if row is not None:
+            self.hits += 1
+            self.cache.move_to_end(c)
+            return row
+        self.misses += 1
+        row = 0
+        nodes = list(self.components[c]) if self.cyclic[c] else []
+        seen = set(self.successors[c])
+        stack = list(seen)
+        while stack:
+            s = stack.pop()
+            nodes.extend(self.components[s])
+            cached = self.cache.get(s)
+            if cached is not None:
+                row |= cached
+                continue
+            for t in self.successors[s]:
+                if t not in seen:
+                    seen.add(t)
+                    stack.append(t)
+        if nodes:
+            bits = bytearray(max(nodes) // 8 + 1)
+            for node in nodes:
+                bits[node >> 3] |= 1 << (node & 7)
+            row |= int.from_bytes(bits, "little")
+        self.cache[c] = row
+        self.cached_bytes += row.bit_length() // 8 + 32
+        while self.cached_bytes > self.max_bytes and len(self.cache) > 1:
+            _, evicted = self.cache.popitem(last=False)
+            self.cached_bytes -= evicted.bit_length() // 8 + 32
+        return row
+
+    def __len__(self):
+        return len(self.component_of)
+    def __iter__(self):
+        for i in range(len(self)):
+            yield iter_bits(self.row(i))
+    def row(self, i: int) -> int:
+        return self.component_row(self.component_of[i])
+    def contains(self, i: int, j: int) -> bool:
+        return (self.row(i) >> j) & 1 == 1
+    def edge_count(self) -> int:
+        return sum(len(component) * self.component_row(c).bit_count() for c, component in enumerate(self.components))
+    def update(self, graph: Graph, nodes) -> dict:
+        # Same contract as Closure.update. The condensation still describes the old graph, so the
+        # nodes which can reach one of the changed nodes and their old rows are found from it before
+        # it is rebuilt.
+        N = len(self)
+        changed = {self.component_of[i] for i in nodes if i < N}
+        predecessors = [[] for _ in self.components]
+        for c, successors in enumerate(self.successors):
+            for s in successors:
+                predecessors[s].append(c)
+        stack = list(changed)
+        while stack:
+            for p in predecessors[stack.pop()]:
+                if p not in changed:
+                    changed.add(p)
+                    stack.append(p)
+        old = {i: self.row(i) for c in changed for i in self.components[c]}
+        old.update((i, 0) for i in nodes if i >= N)
+        self.graph = graph
+        self.condense()
+        return {i: row for i, row in old.items() if self.row(i) != row}
+    def dense(self) -> list:
+        return [bitset_to_list(self.row(i), len(self)) for i in range(len(self))]
+    def print_stats(self, out=sys.stdout):
+        print("closure rows: {} computed, {} from cache, {} cached in {:.1f}MB".format(
+            self.misses, self.hits, len(self.cache), self.cached_bytes / 2**20
+        ), file=out)
+
+class Statistics:
+    # All the numbers the reports need, computed in a single pass over the graph and closure. Nodes in
+    # the same strongly connected component share a closure row so each row is only expanded once.
+    def __init__(self, graph: Graph, closure: Closure, is_tu: list):
+        N = len(graph)
+        self.nodes = N
+        self.translation_units = sum(is_tu)
+        self.direct_edges = graph.edge_count()
+        self.closure_edges = 0
+        self.direct_in_degree = [0] * N
+        self.direct_in_degree_tu = [0] * N
+        self.transitive_in_degree = [0] * N
+        # for headers this is the number of translation units which have to be rebuilt when it changes
+        self.transitive_in_degree_tu = [0] * N
+        self.cyclic_nodes = []
+        self.cycles = [] # strongly connected components which form a cycle
+        for i in range(N):
+            for j in graph[i]:
+                self.direct_in_degree[j] += 1
+                if is_tu[i]:
+                    self.direct_in_degree_tu[j] += 1
+        for component in strongly_connected_components(graph):
+            row = closure.row(component[0])
+            weight = len(component)
+            tu_weight = sum(is_tu[i] for i in component)
+            self.closure_edges += weight * row.bit_count()
+            for j in iter_bits(row):
+                self.transitive_in_degree[j] += weight
+                self.transitive_in_degree_tu[j] += tu_weight
+            if (row >> component[0]) & 1:
+                self.cyclic_nodes.extend(component)
+                self.cycles.append(sorted(component))
+        self.cyclic_nodes.sort()
+        self.cycles.sort()
+        self.update_densities()
+
+    def update_densities(self):
+        N = self.nodes
+        self.direct_density = self.direct_edges / N**2 if N > 0 else 0
+        self.indirect_density = self.closure_edges / N**2 if N > 0 else 0
+
+    def update(self, graph: Graph, closure: Closure, is_tu: list, old_successors: dict, old_rows: dict):
+        # Applies an incremental update: old_successors and old_rows map the nodes whose direct
+        # dependencies or closure rows changed to their previous values. New nodes have no previous
+        # successors and an empty previous row.
+        N = len(graph)
+        for degrees in (self.direct_in_degree, self.direct_in_degree_tu, self.transitive_in_degree, self.transitive_in_degree_tu):
+            degrees.extend([0] * (N - self.nodes))
+        self.nodes = N
+        self.translation_units = sum(is_tu)
+        for i, successors in old_successors.items():
+            weight = 1 if is_tu[i] else 0
+            for j in successors:
+                self.direct_in_degree[j] -= 1
+                self.direct_in_degree_tu[j] -= weight
+            for j in graph[i]:
+                self.direct_in_degree[j] += 1
+                self.direct_in_degree_tu[j] += weight
+            self.direct_edges += len(graph[i]) - len(successors)
+        cyclic = set(self.cyclic_nodes)
+        for i, old_row in old_rows.items():
+            weight = 1 if is_tu[i] else 0
+            row = closure.row(i)
+            for j in iter_bits(old_row & ~row):
+                self.transitive_in_degree[j] -= 1
+                self.transitive_in_degree_tu[j] -= weight
+            for j in iter_bits(row & ~old_row):
+                self.transitive_in_degree[j] += 1
+                self.transitive_in_degree_tu[j] += weight
+            self.closure_edges += row.bit_count() - old_row.bit_count()
+            if (row >> i) & 1:
+                cyclic.add(i)
+            else:
+                cyclic.discard(i)
+        self.cyclic_nodes = sorted(cyclic)
+        # nodes on a cycle share a row with exactly the other members of their component
+        components = {}
+        for i in self.cyclic_nodes:
+            components.setdefault(closure.row(i), []).append(i)
+        self.cycles = sorted(components.values())
+        self.update_densities()
 
-    def process_include(self, base: str, file_path: str, search_paths: list):
+    def counts(self, degrees: list, labels: list) -> dict:
+        # label -> count for every node with a non-zero count
+        return {labels[i]: count for i, count in enumerate(degrees) if count > 0}
+
+# Cost model
+# How much source text every file drags into the build. A translation unit's preprocessed size is its
+# own size plus the size of every file in its closure row, each header counted once as if it had an
+# include guard. A header's attributed cost is its size times the number of translation units which
+# reach it, so the attributed costs add up to the total preprocessed size. Closure rows are never
+# expanded: weights are split into bit planes, making a weighted sum over a row a few ANDs and
+# popcounts, and the per-node translation unit counts are added up as binary counters of bit planes.
+cost_metrics = ["size", "lines", "tokens"]
+
+def bit_planes(values: list) -> list:
+    # plane b has bit i set if bit b of values[i] is set
+    planes = []
+    for b in range(max(values, default=0).bit_length()):
+        bits = bytearray((len(values) + 7) // 8)
+        for i, value in enumerate(values):
+            if (value >> b) & 1:
+                bits[i >> 3] |= 1 << (i & 7)
+        planes.append(int.from_bytes(bits, "little"))
+    return planes
+
+def weighted_count(row: int, planes: list) -> int:
+    # sum of values[i] for every bit i set in row
+    return sum((row & plane).bit_count() << b for b, plane in enumerate(planes))
+
+class Costs:
+    def __init__(self, closure: Closure, is_tu: list, metrics: dict):
+        # metrics maps a metric name to its value for every node, metrics which aren't known for
+        # every file (tokens with --fast-scan) are left out
+        N = len(closure)
+        self.metrics = metrics
+        self.tus = [i for i in range(N) if is_tu[i]]
+        self.tu_positions = {i: k for k, i in enumerate(self.tus)}
+        weights = {name: bit_planes(values) for name, values in metrics.items()}
+        self.preprocessed = {name: [] for name in metrics} # metric -> preprocessed total of every translation unit, in self.tus order
+        # translation units reaching each node, every row is added to a column-wise binary counter
+        planes = []
+        for i in self.tus:
+            # rows are used once, a lazy closure doesn't have to keep them
+            row = closure.row(i) | 1 << i
+            for name in metrics:
+                self.preprocessed[name].append(weighted_count(row, weights[name]))
+            carry = row
+            k = 0
+            while carry:
+                if k == len(planes):
+                    planes.append(0)
+                planes[k], carry = planes[k] ^ carry, planes[k] & carry
+                k += 1
+        self.including_tus = [0] * N
+        for k, plane in enumerate(planes):
+            for j in iter_bits(plane):
+                self.including_tus[j] += 1 << k
+        self.attributed = {} # metric -> attributed cost of every node
+        self.totals = {}
+        for name, values in metrics.items():
+            self.attributed[name] = [value * count for value, count in zip(values, self.including_tus)]
+            self.totals[name] = sum(self.preprocessed[name])
+
+    def node(self, i: int) -> dict:
+        # the cost fields of one node, None for metrics which aren't known, preprocessed totals are
+        # only there for translation units
+        record = {"including_tus": self.including_tus[i]}
+        for name in cost_metrics:
+            known = name in self.metrics
+            record[name] = self.metrics[name][i] if known else None
+            record["attributed_" + name] = self.attributed[name][i] if known else None
+            if i in self.tu_positions:
+                record["preprocessed_" + name] = self.preprocessed[name][self.tu_positions[i]] if known else None
+        return record
+
+    def ranked(self, is_tu: list, metric: str = "size") -> list:
+        # headers by attributed cost, most expensive first
+        return sorted(
+            (i for i in range(len(is_tu)) if not is_tu[i] and self.attributed[metric][i] > 0),
+            key=lambda i: -self.attributed[metric][i]
+        )
+
+# Conditional evaluation
+# With --conditionals, #if/#ifdef/... are evaluated against the macros a translation unit is compiled
+# with: the platform's predefined macros and the -D/-U flags of its compile command. Includes in
+# branches which are known to be dead aren't resolved or followed. Everything else is kept: values
+# are 1, 0 or None when they can't be known (a macro nobody defined or undefined, a function-like
+# macro, __has_include, ...), and a branch is only dropped if its condition is known to be false.
+# Macros defined in other headers aren't carried over, every file starts from the translation unit's
+# macros and only sees its own #define and #undef.
+# A macros dict maps a name to its replacement text, None for function-like macros and False for
+# macros known to be undefined. Names which aren't in it are unknown.
+platform_macros = {
+    "linux": {
+        "__linux__": "1", "__linux": "1", "__unix__": "1", "__unix": "1",
+        "_WIN32": False, "_WIN64": False, "__APPLE__": False, "__MACH__": False, "_MSC_VER": False, "__CYGWIN__": False
+    },
+    "macos": {
+        "__APPLE__": "1", "__MACH__": "1",
+        "_WIN32": False, "_WIN64": False, "__linux__": False, "__linux": False, "__unix__": False, "_MSC_VER": False, "__CYGWIN__": False
+    },
+    "windows": {
+        "_WIN32": "1",
+        "__linux__": False, "__linux": False, "__unix__": False, "__unix": False, "__APPLE__": False, "__MACH__": False
+    },
+    "none": {}
+}
+host_platform = {"linux": "linux", "darwin": "macos", "win32": "windows", "cygwin": "windows"}.get(sys.platform, "none")
+integer_literal_regex = re.compile(r"(0[xX][0-9a-fA-F']+|0[bB][01']+|[0-9][0-9']*)(?:[uU](?:ll|LL|[lLzZ])?|(?:ll|LL|[lLzZ])[uU]?)?")
+char_escapes = {"n": 10, "t": 9, "r": 13, "0": 0, "\\": 92, "'": 39, "\"": 34, "a": 7, "b": 8, "f": 12, "v": 11, "?": 63}
+# binary operators by precedence, loosest first
+binary_operators = [("||", ), ("&&", ), ("|", ), ("^", ), ("&", ), ("==", "!="), ("<", ">", "<=", ">="), ("<<", ">>"), ("+", "-"), ("*", "/", "%")]
+max_expansion = 10000 # tokens, longer expansions are unknown
+
+def and3(a, b):
+    if a == 0 or b == 0:
+        return 0
+    return None if a is None or b is None else 1
+
+def or3(a, b):
+    if (a is not None and a != 0) or (b is not None and b != 0):
+        return 1
+    return None if a is None or b is None else 0
+
+def not3(a):
+    return None if a is None else int(a == 0)
+
+def macro_defined(name: str, macros: dict):
+    if name not in macros:
+        return None
+    return int(macros[name] is not False)
+
+def directive_tokens(text: str) -> list:
+    return [m.group("TOKEN") for m in directive_token_regex.finditer(text) if m.group("TOKEN") is not None]
+
+def expand_macros(tokens: list, macros: dict, hidden: frozenset = frozenset()) -> list:
+    # replaces object-like macros by their expansion, the operands of defined are left alone
+    expanded = []
+    k = 0
+    while k < len(tokens):
+        token = tokens[k]
+        k += 1
+        if token == "defined":
+            end = k + (3 if k < len(tokens) and tokens[k] == "(" else 1)
+            expanded.extend(tokens[k - 1 : end])
+            k = end
+        elif isinstance(macros.get(token), str) and token not in hidden:
+            expanded.extend(expand_macros(directive_tokens(macros[token]), macros, hidden | {token}))
+        else:
+            expanded.append(token)
+        if len(expanded) > max_expansion:
+            raise ValueError("expansion too long")
+    return expanded
+
+class ConditionParser:
+    # Recursive descent over the tokens of an #if expression, evaluating while parsing. Raises
+    # ValueError on anything it doesn't understand.
+    def __init__(self, tokens: list, macros: dict):
+        self.tokens = tokens
+        self.macros = macros
+        self.k = 0
+
+    def peek(self):
+        return self.tokens[self.k] if self.k < len(self.tokens) else None
+
+    def take(self, expected: str = None) -> str:
+        token = self.peek()
+        if token is None or (expected is not None and token != expected):
+            raise ValueError("expected {}".format(expected))
+        self.k += 1
+        return token
+
+    def expression(self):
+        condition = self.binary(0)
+        if self.peek() != "?":
+            return condition
+        self.take("?")
+        a = self.expression()
+        self.take(":")
+        b = self.expression()
+        if condition is None:
+            return a if a == b else None
+        return a if condition != 0 else b
+
+    def binary(self, level: int):
+        if level == len(binary_operators):
+            return self.unary()
+        value = self.binary(level + 1)
+        while self.peek() in binary_operators[level]:
+            operator = self.take()
+            value = self.apply(operator, value, self.binary(level + 1))
+        return value
+
+    def apply(self, operator: str, a, b):
+        if operator == "&&":
+            return and3(a, b)
+        if operator == "||":
+            return or3(a, b)
+        if a is None or b is None:
+            return None
+        if operator in ("/", "%"):
+            if b == 0:
+                return None
+            quotient = abs(a) // abs(b) * (1 if (a < 0) == (b < 0) else -1)
+            return quotient if operator == "/" else a - b * quotient
+        if operator in ("<<", ">>") and not 0 <= b < 64:
+            return None
+        return {
+            "|": lambda: a | b, "^": lambda: a ^ b, "&": lambda: a & b, "==": lambda: int(a == b), "!=": lambda: int(a != b),
+            "<": lambda: int(a < b), ">": lambda: int(a > b), "<=": lambda: int(a <= b), ">=": lambda: int(a >= b),
+            "<<": lambda: a << b, ">>": lambda: a >> b, "+": lambda: a + b, "-": lambda: a - b, "*": lambda: a * b
+        }[operator]()
+
+    def unary(self):
+        token = self.take()
+        if token in ("+", "-", "!", "~"):
+            value = self.unary()
+            if token == "!":
+                return not3(value)
+            if value is None:
+                return None
+            return {"+": value, "-": -value, "~": ~value}[token]
+        if token == "(":
+            value = self.expression()
+            self.take(")")
+            return value
+        if token == "defined":
+            if self.peek() == "(":
+                self.take("(")
+                name = self.take()
+                self.take(")")
+            else:
+                name = self.take()
+            return macro_defined(name, self.macros)
+        if token[0].isdigit():
+            m = integer_literal_regex.fullmatch(token)
+            if m is None:
+                raise ValueError("not an integer: " + token)
+            digits = m.group(1).replace("'", "")
+            if digits[:2] in ("0x", "0X", "0b", "0B"):
+                return int(digits[2:], 16 if digits[1] in "xX" else 2)
+            return int(digits, 8 if digits.startswith("0") else 10)
+        if token[0] == "'":
+            body = token[1:-1]
+            if len(body) == 1:
+                return ord(body)
+            if len(body) == 2 and body[0] == "\\" and body[1] in char_escapes:
+                return char_escapes[body[1]]
+            return None
+        if token[0].isalpha() or token[0] in "_$":
+            if self.peek() == "(":
+                # a function-like macro or __has_include and friends, skip the arguments
+                depth = 0
+                while True:
+                    argument = self.take()
+                    depth += {"(": 1, ")": -1}.get(argument, 0)
+                    if depth == 0:
+                        return None
+            if token in ("true", "false"):
+                return int(token == "true")
+            # identifiers left after expansion are 0 if known to be undefined
+            return 0 if self.macros.get(token) is False else None
+        raise ValueError("unexpected " + token)
+
+def evaluate_condition(expression: str, macros: dict):
+    # the value of an #if expression, None if it can't be known
+    try:
+        parser = ConditionParser(expand_macros(directive_tokens(expression), macros), macros)
+        value = parser.expression()
+        if parser.peek() is not None:
+            return None
+        return value
+    except (ValueError, RecursionError):
+        return None
+
+def directive_condition(kind: str, argument: str, macros: dict):
+    if kind in ("ifdef", "elifdef"):
+        return macro_defined(argument, macros)
+    if kind in ("ifndef", "elifndef"):
+        return not3(macro_defined(argument, macros))
+    return evaluate_condition(argument, macros)
+
+def active_includes(result: dict, macros: dict) -> list:
+    # the includes of a parse result which are in live or possibly live branches for macros
+    skeleton = result["skeleton"]
+    if skeleton is None:
+        return result["includes"]
+    includes = []
+    local = macros # copied before the file's own #define/#undef change it
+    live = 1
+    frames = [] # (live outside, some branch taken) per open #if
+    for k, entry in enumerate(skeleton):
+        kind = entry[0]
+        if kind == "include":
+            if live != 0:
+                includes.append(result["includes"][entry[1]])
+        elif kind in ("define", "undef"):
+            if live == 0:
+                continue
+            if local is macros:
+                local = dict(macros)
+            if live is None:
+                # maybe defined, maybe not
+                local.pop(entry[1], None)
+            else:
+                local[entry[1]] = entry[2] if kind == "define" else False
+        elif kind in ("if", "ifdef", "ifndef"):
+            # the include guard is entered, the file is only included once per translation unit anyway
+            condition = 1 if k == 0 and result["guard"] is not None else directive_condition(kind, entry[1], local) if live != 0 else 0
+            frames.append((live, condition))
+            live = and3(live, condition)
+        elif not frames:
+            # unbalanced #elif, #else or #endif
+            continue
+        elif kind == "endif":
+            live = frames.pop()[0]
+        else:
+            outside, taken = frames[-1]
+            condition = 1 if kind == "else" else directive_condition(kind, entry[1], local) if outside != 0 else 0
+            live = and3(outside, and3(not3(taken), condition))
+            frames[-1] = (outside, or3(taken, condition))
+    return includes
+
+class Analysis:
+    def __init__(self, excludes: list, sentinels: list, parse=parse_includes, cache: ParseCache = None, resolver: IncludeResolver = None):
+        self.excludes = excludes
+        self.sentinels = sentinels
+        self.parse = parse # parse_includes, scan_includes or verify_scan
+        self.cache = cache
+        self.resolver = resolver if resolver is not None else IncludeResolver()
+        self.parsed = {} # absolute path -> parse result, filled by get_includes or ahead of time by prefetch
+        self.not_found = set()
+        self.unresolved = set() # absolute paths of files with an include which wasn't found
+        self.failed = set() # files whose changes update() couldn't apply because of a parse error
+        self.visited = set() # absolute paths processed in at least one context
+        self.translation_units = set() # absolute paths of the files from compile_commands
+        self.units = [] # (absolute path, search paths, defines) of the translation units in the order they were processed
+        # A file is processed once per distinct context it is reached with: the translation unit's
+        # search paths and, with conditionals, its macros. Identical contexts share a number, the parse
+        # result is shared by all contexts.
+        self.predefined_macros = None # platform macros, None doesn't evaluate conditionals
+        self.macro_sets = {} # macros as sorted (name, value) tuples -> dict
+        self.context_numbers = {} # (search paths, macros) -> context number
+        self.contexts = {} # (absolute path, context number) pairs which were processed -> dependencies in that context
+        self.file_contexts = {} # absolute path -> (search paths, macros) of every context it was processed in
+        self.previous = None # during update, absolute path -> dependencies before it for changed nodes
+        self.closure_cache = None # if set, closures are computed lazily with a cache of this many bytes
+        # absolute path -> { i: number, dependencies: list[absolute path]}
+        self.nodes = {}
+        # self.process_file(file_path)
+
+    def find_include(self, base: str, file_path: str, search_paths: list):
+        return self.resolver.resolve(os.path.dirname(base), file_path, tuple(search_paths))
+
+    def resolve_include(self, base: str, file_path: str, search_paths: list):
+        found = self.find_include(base, file_path, search_paths)
+        if found is not None:
+            print("        Found:", found)
+            return os.path.abspath(found)
+
+    def process_include(self, base: str, file_path: str, search_paths: tuple, dependencies: set):
+        # resolves one include of base and adds it to dependencies, returns the resolved path for the
+        # caller to process
         resolved = self.resolve_include(base, file_path, search_paths)
         if resolved:
             print("Recursing into {}".format(file_path))
-            self.process_file(resolved, search_paths)
+            dependencies.add(resolved)
             return resolved
-        else:
-            self.not_found.add(file_path)
-            return None
+        self.not_found.add(file_path)
+        self.unresolved.add(base)
+        if file_path in self.sentinels:
+            if file_path not in self.nodes:
+                self.nodes[file_path] = {
+                    "i": len(self.nodes),
+                    "dependencies": set()
+                }
+            dependencies.add(file_path)
+        return None
 
-    def process_file(self, path: str, search_paths: list):
-        if path in self.visited:
-            return
+    def get_includes(self, path: str) -> list:
+        if path not in self.parsed:
+            if self.cache is not None:
+                self.parsed[path] = self.cache.get(path, self.parse)
+            else:
+                self.parsed[path] = self.parse(path)
+        return self.parsed[path]["includes"]
+
+    def is_excluded(self, path: str) -> bool:
         for exclude in self.excludes:
             if path.startswith(exclude):
-                return
+                return True
+        return False
+
+    def prefetch(self, roots: list, jobs: int):
+        # Parses every file reachable from the (path, search paths, defines) roots in worker processes. The
+        # coordinator owns all state and resolves includes itself, workers only return include lists.
+        # The graph is still built by the depth-first process_file traversal afterwards, which finds
+        # the include lists already parsed, so node numbering is the same as for a serial run. Like the
+        # traversal, every file is expanded once per context it's reached with and parsed only once.
+        queued = set()
+        worklist = collections.deque()
+        pending = {} # future -> path
+        waiting = {} # path being parsed -> contexts to expand it with once it's done
+        def enqueue(path: str, context: tuple):
+            if (path, context) not in queued and not self.is_excluded(path):
+                queued.add((path, context))
+                worklist.append((path, context))
+        def expand(path: str, context: tuple):
+            search_paths, macros = context
+            for include in self.active_includes(path, macros):
+                found = self.find_include(path, include, search_paths)
+                if found is not None:
+                    enqueue(os.path.abspath(found), context)
+        for path, search_paths, defines in roots:
+            enqueue(path, (tuple(search_paths), self.unit_macros(defines)))
+        with concurrent.futures.ProcessPoolExecutor(jobs, initializer=init_worker, initargs=(source_encodings, )) as pool:
+            while worklist or pending:
+                while worklist:
+                    path, context = worklist.popleft()
+                    if path in self.parsed:
+                        expand(path, context)
+                        continue
+                    if path in waiting:
+                        waiting[path].append(context)
+                        continue
+                    result = self.cache.lookup(path, self.parse) if self.cache is not None else None
+                    if result is not None:
+                        self.parsed[path] = result
+                        expand(path, context)
+                    else:
+                        pending[pool.submit(self.parse, path)] = path
+                        waiting[path] = [context]
+                if not pending:
+                    break
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    path = pending.pop(future)
+                    self.parsed[path] = future.result()
+                    if self.cache is not None:
+                        self.cache.store(path, self.parse, self.parsed[path])
+                    for context in waiting.pop(path):
+                        expand(path, context)
+
+    def unit_macros(self, defines: tuple):
+        # the macros of a translation unit compiled with defines, (name, value) pairs from
+        # parse_macros, as an interned tuple, or None without conditionals
+        if self.predefined_macros is None:
+            return None
+        macros = dict(self.predefined_macros)
+        macros.update(defines)
+        key = tuple(sorted(macros.items()))
+        self.macro_sets.setdefault(key, macros)
+        return key
+
+    def active_includes(self, path: str, macros: tuple) -> list:
+        # the includes of path which can be active with macros, all of them without conditionals
+        self.get_includes(path)
+        if macros is None:
+            return self.parsed[path]["includes"]
+        return active_includes(self.parsed[path], self.macro_sets[macros])
+
+    def guard(self, path: str):
+        # the include guard macro of path, #pragma once or None, as detected when it was parsed
+        result = self.parsed.get(path)
+        if result is None:
+            return None
+        if result["guard"] is not None:
+            return result["guard"]
+        return "#pragma once" if result["pragma_once"] else None
+
+    def process_translation_unit(self, path: str, search_paths: list, defines: tuple = ()):
+        self.translation_units.add(path)
+        self.units.append((path, search_paths, defines))
+        self.process_file(path, (tuple(search_paths), self.unit_macros(defines)))
+
+    def enter_file(self, path: str, context: tuple, number: int):
+        # starts processing path in context, whose context number is number, returns its active
+        # includes or None if it was already processed in this context or is excluded
+        if (path, number) in self.contexts:
+            return None
+        if self.is_excluded(path):
+            return None
+        # parsed first, a file which can't be parsed isn't marked as processed
+        includes = self.active_includes(path, context[1])
+        self.contexts[(path, number)] = None
         self.visited.add(path)
-        includes = parse_includes(path)
+        self.file_contexts.setdefault(path, []).append(context)
         # print(path)
         print("    Adding includes:", includes)
+        return includes
+
+    def leave_file(self, path: str, context: tuple, number: int):
+        # undoes enter_file for a file whose processing failed, it's processed again when it's reached
+        del self.contexts[(path, number)]
+        self.file_contexts[path].remove(context)
+        if not self.file_contexts[path]:
+            del self.file_contexts[path]
+            if path not in self.nodes:
+                self.visited.discard(path)
+
+    def add_node(self, path: str, number: int, dependencies: set):
+        # a file's dependencies are those of all its contexts, its number is given when the first one
+        # is finished. The union is a new set, the first context's set is still its own.
+        self.contexts[(path, number)] = dependencies
+        if path in self.nodes:
+            if self.previous is not None and not dependencies <= self.nodes[path]["dependencies"]:
+                self.previous.setdefault(path, set(self.nodes[path]["dependencies"]))
+            self.nodes[path]["dependencies"] = self.nodes[path]["dependencies"] | dependencies
+        else:
+            self.nodes[path] = {
+                "i": len(self.nodes),
+                "dependencies": dependencies
+            }
+
+    def process_file(self, path: str, context: tuple):
+        # Depth-first traversal from path in context, a (search paths, macros) pair. The stack holds
+        # [path, includes, next include, dependencies] for every file being processed, so deep include
+        # chains don't hit the recursion limit. Files are numbered when they're finished, after
+        # everything they include.
+        search_paths = context[0]
+        # hashing the context means hashing every search path and macro, it's only done once
+        number = self.context_numbers.setdefault(context, len(self.context_numbers))
+        includes = self.enter_file(path, context, number)
+        if includes is None:
+            return
+        stack = [[path, includes, 0, set()]]
+        try:
+            while stack:
+                frame = stack[-1]
+                path, includes, k, dependencies = frame
+                if k == len(includes):
+                    stack.pop()
+                    self.add_node(path, number, dependencies)
+                    continue
+                frame[2] = k + 1
+                resolved = self.process_include(path, includes[k], search_paths, dependencies)
+                if resolved is not None:
+                    child = self.enter_file(resolved, context, number)
+                    if child is not None:
+                        stack.append([resolved, child, 0, set()])
+        except Exception:
+            # a parse error, the files which weren't finished aren't left half processed
+            for path, _, _, _ in stack:
+                self.leave_file(path, context, number)
+            raise
+
+    def process_includes(self, path: str, includes: list, context: tuple) -> set:
+        # the dependencies of path in one context, newly reached files are processed
         dependencies = set()
         for include in includes:
-            resolved = self.process_include(path, include, search_paths)
+            resolved = self.process_include(path, include, context[0], dependencies)
             if resolved is not None:
-                dependencies.add(resolved)
-            elif include in self.sentinels:
-                if include not in self.nodes:
-                    self.nodes[include] = {
-                        "i": len(self.nodes),
-                        "dependencies": set()
-                    }
-                dependencies.add(include)
-
-        self.nodes[path] = {
-            "i": len(self.nodes),
-            "dependencies": dependencies
-        }
+                self.process_file(resolved, context)
+        return dependencies
 
-    def build_matrix(self):
+    def update(self, changed_files: list, translation_units: list = []) -> int:
+        # Re-parses changed files and processes new (path, search paths, defines) translation units, then
+        # updates the graph, closure and statistics incrementally. Includes which weren't found before
+        # are resolved again. A file which can't be parsed keeps its old dependencies and ends up in
+        # self.failed, as does a new translation unit, which isn't added. Returns the number of nodes
+        # whose direct dependencies changed.
+        self.resolver.clear()
+        self.failed = set()
         N = len(self.nodes)
-        self.matrix = [[0 for _ in range(N)] for _ in range(N)]
-        for key in self.nodes:
-            node = self.nodes[key]
-            row = node["i"]
-            for d in node["dependencies"]:
-                if d in self.nodes:
-                    self.matrix[row][self.nodes[d]["i"]] = 1
-        # deep copy
-        self.matrix_closure = [[col for col in row] for row in self.matrix]
-        G = self.matrix_closure
-        # floyd-warshall
-        for k in range(N):
-            for i in range(N):
-                for j in range(N):
-                    G[i][j] = G[i][j] or (G[i][k] and G[k][j])
-
-def print_header(matrix, labels):
-    print(" " * 50, end="")
-    for i in range(len(matrix)):
-        print(" {}".format(os.path.basename(labels[i])[0]), end="")
-    print()
-
-def print_matrix(matrix, labels):
-    color = os.isatty(1)
-    for i, row in enumerate(matrix):
-        print("{:>50} ".format(os.path.basename(labels[i])), end="")
-        for j, n in enumerate(row):
-            if i == j:
-                print("{}{}{} ".format(colorama.Fore.BLUE if color else "", "#" if n else "~", colorama.Style.RESET_ALL if color else ""), end="")
-            else:
-                print("{} ".format("#" if n else "~"), end="")
-        print()
-    print()
-
-def count_incident_edges(matrix, labels, tu_only=False):
-    counts = {} # label -> count
-    for col in range(len(matrix)):
-        for row in range(len(matrix)):
-            # if the row is not a .c/.cpp file, it's a header so ignore it
-            if tu_only and not (labels[row].endswith(".cpp") or labels[row].endswith(".c")):
+        changed = set(changed_files)
+        # files reached in a new context get more dependencies too
+        self.previous = {}
+        try:
+            for path in changed_files + sorted(self.unresolved - changed):
+                if path not in self.nodes:
+                    continue
+                parsed = self.parsed.pop(path, None) if path in changed else self.parsed.get(path)
+                unresolved = path in self.unresolved
+                self.unresolved.discard(path)
+                try:
+                    exists = os.path.isfile(path)
+                    dependencies = set()
+                    found = []
+                    for context in self.file_contexts[path]:
+                        includes = self.active_includes(path, context[1]) if exists else []
+                        print("    Adding includes:", includes)
+                        found.append(self.process_includes(path, includes, context))
+                        dependencies |= found[-1]
+                except Exception as e:
+                    print("error: {} not updated: {}".format(path, e), file=sys.stderr)
+                    self.failed.add(path)
+                    if parsed is not None:
+                        self.parsed[path] = parsed
+                    if unresolved:
+                        self.unresolved.add(path)
+                    continue
+                for context, context_dependencies in zip(self.file_contexts[path], found):
+                    self.contexts[(path, self.context_numbers[context])] = context_dependencies
+                self.previous.setdefault(path, self.nodes[path]["dependencies"])
+                self.nodes[path]["dependencies"] = dependencies
+            for path, search_paths, defines in translation_units:
+                try:
+                    self.process_translation_unit(path, search_paths, defines)
+                except Exception as e:
+                    print("error: translation unit {} not added: {}".format(path, e), file=sys.stderr)
+                    self.failed.add(path)
+                    self.translation_units.discard(path)
+                    self.units.pop()
+            old_dependencies = {
+                path: dependencies for path, dependencies in self.previous.items()
+                if self.nodes[path]["i"] < N and dependencies != self.nodes[path]["dependencies"]
+            }
+        finally:
+            self.previous = None
+        updated = len(old_dependencies) + len(self.nodes) - N
+        # removed includes and failures can leave files which aren't reached in some context anymore
+        if self.failed or any(dependencies - self.nodes[path]["dependencies"] for path, dependencies in old_dependencies.items()):
+            pruned = self.prune()
+            if pruned:
+                self.build_matrix(self.closure is not None)
+                return updated + len(pruned)
+        self.update_matrix([self.nodes[path]["i"] for path in old_dependencies], N)
+        return updated
+
+    def prune(self) -> list:
+        # Forgets the contexts a file isn't reached in from a translation unit anymore: its dependencies
+        # are those of the remaining contexts, without any it's removed and the other nodes are numbered
+        # again in the same order. Returns the paths of the changed nodes, build_matrix has to be called
+        # if there are any.
+        stack = []
+        for path, search_paths, defines in self.units:
+            key = (path, self.context_numbers[(tuple(search_paths), self.unit_macros(defines))])
+            if key in self.contexts:
+                stack.append(key)
+        reachable = set(stack)
+        while stack:
+            path, number = stack.pop()
+            for dependency in self.contexts[(path, number)]:
+                key = (dependency, number)
+                if key in self.contexts and key not in reachable:
+                    reachable.add(key)
+                    stack.append(key)
+        stale = [key for key in self.contexts if key not in reachable]
+        if not stale:
+            return []
+        context_of = {number: context for context, number in self.context_numbers.items()}
+        for path, number in stale:
+            del self.contexts[(path, number)]
+            self.file_contexts[path].remove(context_of[number])
+        changed = []
+        for path in {path for path, _ in stale}:
+            changed.append(path)
+            if self.file_contexts[path]:
+                dependencies = set()
+                for context in self.file_contexts[path]:
+                    dependencies |= self.contexts[(path, self.context_numbers[context])]
+                self.nodes[path]["dependencies"] = dependencies
                 continue
-            if matrix[row][col]:
-                if labels[col] in counts:
-                    counts[labels[col]] += 1
-                else:
-                    counts[labels[col]] = 1
-    return counts
+            # they're processed from scratch if they're reached again
+            del self.file_contexts[path]
+            del self.nodes[path]
+            self.visited.discard(path)
+            self.unresolved.discard(path)
+        # sentinels have no contexts, they stay while something includes them
+        included = set()
+        for node in self.nodes.values():
+            included |= node["dependencies"]
+        for path in [path for path in self.nodes if path in self.sentinels and path not in included]:
+            del self.nodes[path]
+            changed.append(path)
+        for i, node in enumerate(self.nodes.values()):
+            node["i"] = i
+        return changed
+
+    def successors(self, node: dict) -> list:
+        return [self.nodes[d]["i"] for d in node["dependencies"] if d in self.nodes]
+
+    def build_matrix(self, closure: bool = True):
+        # Builds the direct dependency graph and, unless it isn't needed, its transitive closure.
+        # Nothing here is dense, use graph.dense() and closure.dense() for an adjacency matrix.
+        adjacency = [self.successors(node) for node in self.nodes.values()]
+        self.graph = Graph(adjacency)
+        self.closure = self.make_closure(self.graph) if closure else None
+        self.labels = list(self.nodes.keys())
+        self.is_tu = [label in self.translation_units for label in self.labels]
+        self.stats = None
+        self.index = None
+        self.cost_model = None
+
+    def make_closure(self, graph: Graph):
+        if self.closure_cache is not None:
+            return LazyClosure(graph, self.closure_cache)
+        return Closure(transitive_closure(graph))
+
+    def update_matrix(self, changed: list, N: int):
+        # changed are the nodes whose dependencies changed, nodes from N on are new
+        labels = list(self.nodes.keys())
+        rows = {i: self.successors(self.nodes[labels[i]]) for i in changed + list(range(N, len(labels)))}
+        old_successors = {i: self.graph[i] if i < N else [] for i in rows}
+        self.graph.update(rows)
+        self.labels = labels
+        self.is_tu = [label in self.translation_units for label in self.labels]
+        self.cost_model = None
+        if self.closure is None:
+            return
+        old_rows = self.closure.update(self.graph, rows.keys())
+        for i in range(N, len(labels)):
+            old_rows.setdefault(i, 0)
+        if self.stats is not None:
+            self.stats.update(self.graph, self.closure, self.is_tu, old_successors, old_rows)
+        if self.index is not None:
+            self.index.update(old_successors)
+
+    def statistics(self) -> Statistics:
+        if self.stats is None:
+            self.stats = Statistics(self.graph, self.closure, self.is_tu)
+        return self.stats
+
+    def costs(self) -> Costs:
+        if self.cost_model is None:
+            metrics = {}
+            results = [self.parsed.get(label) for label in self.labels]
+            for name in cost_metrics:
+                # sentinels weren't parsed and cost nothing
+                values = [result[name] if result is not None else 0 for result in results]
+                if None not in values:
+                    metrics[name] = values
+            self.cost_model = Costs(self.closure, self.is_tu, metrics)
+        return self.cost_model
+
+    def queries(self):
+        # the Queries index, built on first use and kept up to date by update()
+        if self.index is None:
+            self.index = Queries(self)
+        return self.index
+
+# Queries
+# Answers the everyday questions about an analysis: what a file pulls in, what depends on it and
+# which translation units have to be rebuilt when it changes. Dependencies are closure rows, for
+# dependents the closure of the reversed graph is computed once. Both are bitsets, translation units
+# are a bitmask, so every answer costs about as much as the size of the result.
+class Queries:
+    def __init__(self, analysis: Analysis):
+        self.analysis = analysis
+        N = len(analysis.graph)
+        self.reverse_adjacency = [set() for _ in range(N)]
+        for i, j in analysis.graph.edges():
+            self.reverse_adjacency[j].add(i)
+        self.reverse_graph = Graph(self.reverse_adjacency)
+        self.reverse = analysis.make_closure(self.reverse_graph)
+        self.index_labels()
+
+    def index_labels(self):
+        labels = self.analysis.labels
+        self.by_name = collections.defaultdict(list) # file name -> nodes, for suffix lookups
+        self.tu_mask = 0
+        for i, label in enumerate(labels):
+            self.by_name[os.path.basename(label)].append(i)
+            if self.analysis.is_tu[i]:
+                self.tu_mask |= 1 << i
+
+    def update(self, old_successors: dict):
+        # keeps the reverse closure current after Analysis.update_matrix changed the successors of
+        # the nodes in old_successors (node -> successors before)
+        graph = self.analysis.graph
+        self.reverse_adjacency.extend(set() for _ in range(len(graph) - len(self.reverse_adjacency)))
+        changed = set(range(len(self.reverse_graph), len(graph)))
+        for i, old in old_successors.items():
+            old = set(old)
+            new = set(graph[i])
+            for j in old - new:
+                self.reverse_adjacency[j].discard(i)
+            for j in new - old:
+                self.reverse_adjacency[j].add(i)
+            changed |= old ^ new
+        self.reverse_graph.update({j: self.reverse_adjacency[j] for j in changed})
+        self.reverse.update(self.reverse_graph, changed)
+        self.index_labels()
+
+    def node(self, name: str) -> int:
+        # a path, relative path or unambiguous path suffix
+        nodes = self.analysis.nodes
+        for path in (name, os.path.abspath(name)):
+            if path in nodes:
+                return nodes[path]["i"]
+        labels = self.analysis.labels
+        suffix = os.path.sep + name.lstrip(os.path.sep)
+        matches = [i for i in self.by_name.get(os.path.basename(name), []) if labels[i].endswith(suffix)]
+        if len(matches) != 1:
+            raise LookupError("{} file {}".format("ambiguous" if matches else "unknown", name))
+        return matches[0]
+
+    def labels(self, bits: int) -> list:
+        return [self.analysis.labels[i] for i in iter_bits(bits)]
+
+    def includes(self, name: str) -> list:
+        return [self.analysis.labels[j] for j in self.analysis.graph[self.node(name)]]
+
+    def includers(self, name: str) -> list:
+        return [self.analysis.labels[j] for j in self.reverse_graph[self.node(name)]]
+
+    def dependencies(self, name: str) -> list:
+        return self.labels(self.analysis.closure.row(self.node(name)))
+
+    def dependents(self, name: str) -> list:
+        return self.labels(self.reverse.row(self.node(name)))
+
+    def affected(self, name: str) -> int:
+        # bitmask of the translation units which have to be rebuilt if the file changes
+        i = self.node(name)
+        return (self.reverse.row(i) | 1 << i) & self.tu_mask
+
+    def translation_units(self, name: str) -> list:
+        return self.labels(self.affected(name))
+
+    def impact(self, name: str) -> int:
+        return self.affected(name).bit_count()
+
+    def path(self, source: str, target: str):
+        # shortest chain of includes from source to target, None if target isn't reachable
+        i = self.node(source)
+        j = self.node(target)
+        closure = self.analysis.closure
+        if not closure.contains(i, j):
+            return None
+        # breadth first, only through nodes which reach the target
+        parents = {i: None}
+        queue = collections.deque([i])
+        while j not in parents:
+            k = queue.popleft()
+            for successor in self.analysis.graph[k]:
+                if successor not in parents and (successor == j or closure.contains(successor, j)):
+                    parents[successor] = k
+                    queue.append(successor)
+        path = []
+        k = j
+        while k is not None:
+            path.append(self.analysis.labels[k])
+            k = parents[k]
+        return path[::-1]
+
+query_commands = {
+    # command -> (arguments, description)
+    "stats": (0, "the counts section"),
+    "includes": (1, "files FILE includes directly"),
+    "includers": (1, "files which include FILE directly"),
+    "dependencies": (1, "files FILE includes, directly or transitively"),
+    "dependents": (1, "files which include FILE, directly or transitively"),
+    "tus": (1, "translation units which are rebuilt when FILE changes"),
+    "impact": (1, "number of translation units which are rebuilt when FILE changes"),
+    "path": (2, "shortest chain of includes from FILE to FILE2, null if there is none")
+}
 
-def print_graphviz(analysis: Analysis, labels: list):
-    print("digraph G {")
+def answer_query(analysis: Analysis, line: str):
+    # answers one query line, errors are answered with {"error": message}
+    try:
+        words = shlex.split(line)
+    except ValueError as e:
+        return {"error": str(e)}
+    if not words:
+        return {"error": "empty query"}
+    command, arguments = words[0], words[1:]
+    if command not in query_commands:
+        return {"error": "unknown command {}, expected one of {}".format(command, ", ".join(query_commands))}
+    if len(arguments) != query_commands[command][0]:
+        return {"error": "usage: {}".format(" ".join([command] + ["FILE", "FILE2"][:query_commands[command][0]]))}
+    if command == "stats":
+        return statistics_summary(analysis.statistics(), analysis.labels)
+    try:
+        return getattr(analysis.queries(), command if command != "tus" else "translation_units")(*arguments)
+    except LookupError as e:
+        return {"error": e.args[0]}
+
+def print_header(matrix, labels, out=sys.stdout):
+    out.write(" " * 50 + "".join(" {}".format(os.path.basename(labels[i])[0]) for i in range(len(matrix))) + "\n")
+
+def print_matrix(matrix, labels, out=sys.stdout):
+    color = out.isatty()
+    for i, row in enumerate(matrix):
+        cells = ["#" if n else "~" for n in row]
+        if color:
+            cells[i] = "{}{}{}".format(colorama.Fore.BLUE, cells[i], colorama.Style.RESET_ALL)
+        out.write("{:>50} {} \n".format(os.path.basename(labels[i]), " ".join(cells)))
+    out.write("\n")
+
+def transitive_reduction(graph: Graph, closure: Closure) -> list:
+    # Successor lists of the transitive reduction. With cycles the reduction is taken over the
+    # condensation: edges within a strongly connected component are kept, of the edges from one
+    # component to another only the first is kept, and none if the target component can also be
+    # reached through another component the source has edges to.
+    N = len(graph)
+    component_of = [0] * N
+    components = strongly_connected_components(graph)
+    masks = []
+    for c, component in enumerate(components):
+        mask = 0
+        for node in component:
+            component_of[node] = c
+            mask |= 1 << node
+        masks.append(mask)
+    kept = set() # (u, w) edges between components which are kept
+    for c, component in enumerate(components):
+        targets = {} # target component -> first edge into it
+        for u in sorted(component):
+            for w in graph[u]:
+                if component_of[w] != c:
+                    targets.setdefault(component_of[w], (u, w))
+        covered = 0
+        for d, (u, w) in targets.items():
+            # everything reachable from component d, except for d itself
+            covered |= closure.row(w) & ~masks[d]
+        kept.update((u, w) for u, w in targets.values() if not (covered >> w) & 1)
+    return [[w for w in graph[u] if component_of[w] == component_of[u] or (u, w) in kept] for u in range(N)]
+
+def group_key(label: str, aggregate: str) -> str:
+    if aggregate == "directory":
+        return os.path.dirname(label)
+    else:
+        # YYY.c/cpp and YYY.h are the same module wherever they are, module names are unique across
+        # directories (src/YYY.c and include/YYY.h)
+        return os.path.splitext(os.path.basename(label))[0]
+
+def aggregate_graph(analysis: Analysis, aggregate: str):
+    # Collapses nodes by directory or module. Returns the group keys, the group graph and its closure
+    # and for every group the number of translation units which transitively include any of its files.
+    groups = {} # key -> group index, in order of first appearance
+    group_of = []
+    for label in analysis.labels:
+        group_of.append(groups.setdefault(group_key(label, aggregate), len(groups)))
+    adjacency = [set() for _ in range(len(groups))]
+    for i, j in analysis.graph.edges():
+        if group_of[i] != group_of[j]:
+            adjacency[group_of[i]].add(group_of[j])
+    graph = Graph(adjacency)
+    tu_counts = [0] * len(groups)
+    for i, is_tu in enumerate(analysis.is_tu):
+        if is_tu:
+            for g in {group_of[j] for j in iter_bits(analysis.closure.row(i))}:
+                tu_counts[g] += 1
+    return list(groups.keys()), graph, Closure(transitive_closure(graph)), tu_counts
+
+def graphviz_labels(keys: list, aggregate: str) -> list:
+    if aggregate == "directory":
+        # directories relative to the deepest directory they all share
+        absolute = [key for key in keys if os.path.isabs(key)]
+        common = os.path.commonpath(absolute) if absolute else ""
+        return [os.path.relpath(key, common) if common and os.path.isabs(key) else key for key in keys]
+    return [os.path.basename(key) for key in keys]
+
+def print_graphviz(analysis: Analysis, labels: list, out=sys.stdout, reduce: bool = False, aggregate: str = None):
+    # reduce draws the transitive reduction instead of the direct dependencies and the closure,
+    # aggregate ("directory" or "module") collapses nodes into groups
+    if aggregate is not None:
+        keys, graph, closure, counts = aggregate_graph(analysis, aggregate)
+        labels = graphviz_labels(keys, aggregate)
+    else:
+        graph = analysis.graph
+        closure = analysis.closure
+        counts = analysis.statistics().transitive_in_degree_tu
+        labels = [os.path.basename(label) for label in labels]
+    out.write("digraph G {\n")
     #print("\tnodesep=0.3;")
     #print("\tranksep=0.2;")
     #print("\tnode [shape=circle, fixedsize=true];")
     #print("\tedge [arrowsize=0.8];")
     #print("\tlayout=fdp;")
 
-    # counts = count_incident_edges(analysis.matrix, labels, True)
-    counts = count_incident_edges(analysis.matrix_closure, labels, True)
-    max_count = max(counts.values())
-    def get_count_color(label: str):
-        if label in counts:
-            return min(int(math.floor((counts[label] / max_count) * 9)) + 1, 9)
+    max_count = max(counts, default=0) or 1
+    def get_count_color(i: int):
+        if counts[i] > 0:
+            return min(int(math.floor((counts[i] / max_count) * 9)) + 1, 9)
         else:
             return "white"
-    print("\tsubgraph cluster_{} {{".format("direct"))
-    print("\t\tnode [colorscheme=reds9] # Apply colorscheme to all nodes")
-    print("\t\tlabel=\"{}\";".format("direct dependencies"))
-    for i in range(len(labels)):
-        print("\t\tn{} [label=\"{}\", fillcolor={}, style=\"filled,solid\"];".format(i, os.path.basename(labels[i]), get_count_color(labels[i])))
-    print("\t\t", end="")
-    for i, row in enumerate(analysis.matrix):
-        for j, v in enumerate(row):
-            if v:
-                print("n{}->n{};".format(i, j), end="")
-    print()
-    print("\t}")
+    def print_cluster(name: str, label: str, offset: int):
+        out.write("\tsubgraph cluster_{} {{\n".format(name))
+        out.write("\t\tnode [colorscheme=reds9] # Apply colorscheme to all nodes\n")
+        out.write("\t\tlabel=\"{}\";\n".format(label))
+        for i in range(len(labels)):
+            out.write("\t\tn{} [label=\"{}\", fillcolor={}, style=\"filled,solid\"];\n".format(i + offset, labels[i], get_count_color(i)))
+
+    if reduce:
+        print_cluster("reduced", "transitive reduction", 0)
+        out.write("\t\t")
+        for i, row in enumerate(transitive_reduction(graph, closure)):
+            out.write("".join("n{}->n{};".format(i, j) for j in row))
+        out.write("\n")
+        out.write("\t}\n")
+        out.write("}\n")
+        return
+
+    print_cluster("direct", "direct dependencies", 0)
+    out.write("\t\t")
+    for i, row in enumerate(graph):
+        out.write("".join("n{}->n{};".format(i, j) for j in row))
+    out.write("\n")
+    out.write("\t}\n")
 
     offset = len(labels)
-    # counts = count_incident_edges(analysis.matrix_closure, labels, True)
-    # max_count = max(counts.values())
-    # def get_count_color(label: str):
-    #     if label in counts:
-    #         return min(int(math.floor((counts[label] / max_count) * 10)), 9)
-    #     else:
-    #         return "white"
-    print("\tsubgraph cluster_{} {{".format("indirect"))
-    print("\t\tnode [colorscheme=reds9] # Apply colorscheme to all nodes")
-    print("\t\tlabel=\"{}\";".format("dependency transitive closure"))
-    for i in range(len(labels)):
-        print("\t\tn{} [label=\"{}\", fillcolor={}, style=\"filled,solid\"];".format(i + offset, os.path.basename(labels[i]), get_count_color(labels[i])))
-    print("\t\t", end="")
-    for i, row in enumerate(analysis.matrix_closure):
-        for j, v in enumerate(row):
-            if v:
-                print("n{}->n{}[color={}];".format(i + offset, j + offset, "black" if analysis.matrix[i][j] else "orange"), end="")
-    print()
-    print("\t}")
-    print("}")
-
-def parse_search_paths(command: str) -> list:
-    paths = [x.group(1) for x in re.finditer(r"-I([^ ]+)", command)]
+    print_cluster("indirect", "dependency transitive closure", offset)
+    out.write("\t\t")
+    for i, columns in enumerate(closure):
+        direct = set(graph[i])
+        out.write("".join("n{}->n{}[color={}];".format(i + offset, j + offset, "black" if j in direct else "orange") for j in columns))
+    out.write("\n")
+    out.write("\t}\n")
+    out.write("}\n")
+
+def print_counts(title: str, counts: dict, out=sys.stdout):
+    lines = [title]
+    for name, count in sorted(counts.items(), key=lambda x: x[1], reverse=True):
+        lines.append("{} {}".format(os.path.basename(name), count))
+    out.write("\n".join(lines) + "\n")
+
+def print_statistics(stats: Statistics, labels: list, out=sys.stdout):
+    out.write("translation units: {}\n".format(stats.translation_units))
+    out.write("direct density: {:.0f}%\n".format(100 * stats.direct_density))
+    out.write("indirect density: {:.0f}%\n".format(100 * stats.indirect_density))
+    out.write("cyclic dependencies: {}\n".format("yes" if stats.cyclic_nodes else "no"))
+    for cycle in stats.cycles:
+        out.write("    cycle: {}\n".format(" ".join(os.path.basename(labels[i]) for i in cycle)))
+    out.write("\n\n")
+    print_counts("Dependency counts:", stats.counts(stats.direct_in_degree, labels), out)
+    out.write("\n\n")
+    print_counts("Transitive dependency counts:", stats.counts(stats.transitive_in_degree, labels), out)
+    out.write("\n\n")
+    print_counts("Dependency counts (TU-only):", stats.counts(stats.direct_in_degree_tu, labels), out)
+    out.write("\n\n")
+    print_counts("Transitive dependency counts (TU-only):", stats.counts(stats.transitive_in_degree_tu, labels), out)
+
+def print_costs(analysis: Analysis, out=sys.stdout, top: int = 20):
+    costs = analysis.costs()
+    labels = analysis.labels
+    metrics = [name for name in cost_metrics if name in costs.metrics]
+    tus = len(costs.tus)
+    out.write("Preprocessed source per translation unit (every header counted once):\n")
+    for name in metrics:
+        out.write("    {:6} total {:>14,}  average {:>12,.0f}\n".format(name, costs.totals[name], costs.totals[name] / tus if tus > 0 else 0))
+    out.write("\n")
+    out.write("Most expensive headers (size x translation units including them):\n")
+    out.write("    {:>14} {:>6} {:>10} {:>8} {:>9} {:>6}  {}\n".format("attributed", "share", "size", "lines", "tokens", "TUs", "header"))
+    total = costs.totals.get("size", 0)
+    for i in costs.ranked(analysis.is_tu)[:top]:
+        out.write("    {:>14,} {:>6.1%} {:>10,} {:>8,} {:>9} {:>6}  {}\n".format(
+            costs.attributed["size"][i],
+            costs.attributed["size"][i] / total if total > 0 else 0,
+            costs.metrics["size"][i],
+            costs.metrics["lines"][i],
+            "{:,}".format(costs.metrics["tokens"][i]) if "tokens" in costs.metrics else "-",
+            costs.including_tus[i],
+            labels[i]
+        ))
+    out.write("\n")
+    out.write("Largest translation units:\n")
+    out.write("    {:>14} {:>10}  {}\n".format("preprocessed", "lines", "translation unit"))
+    ranked = sorted(range(tus), key=lambda k: -costs.preprocessed["size"][k])
+    for k in ranked[:top]:
+        out.write("    {:>14,} {:>10,}  {}\n".format(costs.preprocessed["size"][k], costs.preprocessed["lines"][k], labels[costs.tus[k]]))
+    out.write("\n")
+
+def costs_summary(costs: Costs) -> dict:
+    return {
+        "translation_units": len(costs.tus),
+        "totals": costs.totals
+    }
+
+def write_text(analysis: Analysis, sections: set, out, reduce: bool = False, aggregate: str = None, cost_top: int = 20):
+    labels = analysis.labels
+    if "nodes" in sections:
+        for key in analysis.nodes:
+            out.write("{:20} {}\n".format(key, analysis.nodes[key]))
+        out.write("\n")
+    if "graphviz" in sections:
+        print_graphviz(analysis, labels, out, reduce, aggregate)
+    if "matrix" in sections:
+        # the text matrices are the only consumers that need a dense view
+        matrix = analysis.graph.dense()
+        print_header(matrix, labels, out)
+        print_matrix(matrix, labels, out)
+        matrix = analysis.closure.dense()
+        print_header(matrix, labels, out)
+        print_matrix(matrix, labels, out)
+        del matrix
+    if "counts" in sections:
+        print_statistics(analysis.statistics(), labels, out)
+    if "costs" in sections:
+        print_costs(analysis, out, cost_top)
+
+# Machine readable output
+# Every format contains the selected sections: nodes (index, path, whether it's a translation unit),
+# edges (direct dependencies), closure (transitive dependencies), counts (the statistics) and costs
+# (the cost model).
+output_formats = ["text", "json", "ndjson", "sqlite", "npz"]
+output_sections = {
+    "text": ["nodes", "graphviz", "matrix", "counts", "costs"],
+    "json": ["nodes", "edges", "closure", "counts", "costs"],
+    "ndjson": ["nodes", "edges", "closure", "counts", "costs"],
+    "sqlite": ["nodes", "edges", "closure", "counts", "costs"],
+    "npz": ["nodes", "edges", "closure", "counts", "costs"]
+}
+default_sections = {
+    "text": ["nodes", "graphviz", "matrix", "counts"],
+    "json": ["nodes", "edges", "counts"],
+    "ndjson": ["nodes", "edges", "counts"],
+    "sqlite": ["nodes", "edges", "counts"],
+    "npz": ["nodes", "edges", "counts"]
+}
+
+def statistics_summary(stats: Statistics, labels: list) -> dict:
+    return {
+        "translation_units": stats.translation_units,
+        "nodes": stats.nodes,
+        "direct_edges": stats.direct_edges,
+        "closure_edges": stats.closure_edges,
+        "direct_density": stats.direct_density,
+        "indirect_density": stats.indirect_density,
+        "cycles": [[labels[i] for i in cycle] for cycle in stats.cycles]
+    }
+
+def node_statistics(stats: Statistics, i: int) -> dict:
+    return {
+        "direct_in_degree": stats.direct_in_degree[i],
+        "transitive_in_degree": stats.transitive_in_degree[i],
+        "direct_in_degree_tu": stats.direct_in_degree_tu[i],
+        "transitive_in_degree_tu": stats.transitive_in_degree_tu[i]
+    }
+
+def node_records(analysis: Analysis, sections: set):
+    # one dict per node with the data of the selected sections
+    stats = analysis.statistics() if "counts" in sections else None
+    costs = analysis.costs() if "costs" in sections else None
+    for i, label in enumerate(analysis.labels):
+        record = {"i": i}
+        if "nodes" in sections:
+            record["path"] = label
+            record["tu"] = analysis.is_tu[i]
+            record["guard"] = analysis.guard(label)
+        if "edges" in sections:
+            record["dependencies"] = analysis.graph[i].tolist()
+        if "closure" in sections:
+            record["closure"] = list(iter_bits(analysis.closure.row(i)))
+        if stats is not None:
+            record.update(node_statistics(stats, i))
+        if costs is not None:
+            record.update(costs.node(i))
+        yield record
+
+def write_json(analysis: Analysis, sections: set, out):
+    document = {"nodes": list(node_records(analysis, sections))}
+    if "counts" in sections:
+        document["statistics"] = statistics_summary(analysis.statistics(), analysis.labels)
+    if "costs" in sections:
+        document["costs"] = costs_summary(analysis.costs())
+    json.dump(document, out)
+    out.write("\n")
+
+def write_ndjson(analysis: Analysis, sections: set, out):
+    if "counts" in sections:
+        out.write(json.dumps({"statistics": statistics_summary(analysis.statistics(), analysis.labels)}) + "\n")
+    if "costs" in sections:
+        out.write(json.dumps({"costs": costs_summary(analysis.costs())}) + "\n")
+    lines = []
+    for record in node_records(analysis, sections):
+        lines.append(json.dumps(record))
+        if len(lines) == 4096:
+            out.write("\n".join(lines) + "\n")
+            lines = []
+    if lines:
+        out.write("\n".join(lines) + "\n")
+
+def write_sqlite(analysis: Analysis, sections: set, path: str):
+    if os.path.exists(path):
+        os.remove(path)
+    db = sqlite3.connect(path)
+    N = len(analysis.labels)
+    if "nodes" in sections:
+        db.execute("CREATE TABLE nodes (i INTEGER PRIMARY KEY, path TEXT, tu INTEGER, guard TEXT)")
+        db.executemany("INSERT INTO nodes VALUES (?, ?, ?, ?)", zip(range(N), analysis.labels, analysis.is_tu, map(analysis.guard, analysis.labels)))
+    if "edges" in sections:
+        db.execute("CREATE TABLE edges (source INTEGER, target INTEGER)")
+        db.executemany("INSERT INTO edges VALUES (?, ?)", analysis.graph.edges())
+    if "closure" in sections:
+        db.execute("CREATE TABLE closure (source INTEGER, target INTEGER)")
+        db.executemany("INSERT INTO closure VALUES (?, ?)", ((i, j) for i, columns in enumerate(analysis.closure) for j in columns))
+    if "counts" in sections:
+        stats = analysis.statistics()
+        db.execute("CREATE TABLE node_statistics (i INTEGER PRIMARY KEY, direct_in_degree INTEGER, transitive_in_degree INTEGER, direct_in_degree_tu INTEGER, transitive_in_degree_tu INTEGER)")
+        db.executemany("INSERT INTO node_statistics VALUES (?, ?, ?, ?, ?)", zip(
+            range(N),
+            stats.direct_in_degree,
+            stats.transitive_in_degree,
+            stats.direct_in_degree_tu,
+            stats.transitive_in_degree_tu
+        ))
+        db.execute("CREATE TABLE statistics (key TEXT PRIMARY KEY, value TEXT)")
+        db.executemany("INSERT INTO statistics VALUES (?, ?)", (
+            (key, json.dumps(value)) for key, value in statistics_summary(stats, analysis.labels).items()
+        ))
+    if "costs" in sections:
+        costs = analysis.costs()
+        columns = ["including_tus"] + [prefix + name for name in cost_metrics for prefix in ("", "attributed_", "preprocessed_")]
+        db.execute("CREATE TABLE node_costs (i INTEGER PRIMARY KEY, {})".format(", ".join(column + " INTEGER" for column in columns)))
+        db.executemany(
+            "INSERT INTO node_costs VALUES (?, {})".format(", ".join("?" for _ in columns)),
+            ([i] + [record.get(column) for column in columns] for i, record in enumerate(map(costs.node, range(N))))
+        )
+    db.commit()
+    db.close()
+
+def write_npz(analysis: Analysis, sections: set, path: str):
+    try:
+        import numpy
+    except ImportError:
+        raise RuntimeError("--format npz requires numpy")
+    N = len(analysis.labels)
+    arrays = {}
+    if "nodes" in sections:
+        arrays["paths"] = numpy.array(analysis.labels, dtype=str)
+        arrays["tu"] = numpy.array(analysis.is_tu, dtype=bool)
+    if "edges" in sections:
+        # CSR, the dependencies of node i are edge_targets[edge_offsets[i]:edge_offsets[i + 1]]
+        arrays["edge_offsets"] = numpy.frombuffer(analysis.graph.offsets, dtype=numpy.int64 if analysis.graph.offsets.itemsize == 8 else numpy.int32)
+        arrays["edge_targets"] = numpy.frombuffer(analysis.graph.targets, dtype=numpy.int64 if analysis.graph.targets.itemsize == 8 else numpy.int32)
+    if "closure" in sections:
+        # one row of packed bits per node, little bit order: numpy.unpackbits(closure, axis=1, count=N, bitorder="little")
+        row_bytes = (N + 7) // 8
+        closure = numpy.zeros((N, row_bytes), dtype=numpy.uint8)
+        for i in range(N):
+            closure[i] = numpy.frombuffer(analysis.closure.row(i).to_bytes(row_bytes, "little"), dtype=numpy.uint8)
+        arrays["closure"] = closure
+    if "counts" in sections:
+        stats = analysis.statistics()
+        arrays["direct_in_degree"] = numpy.array(stats.direct_in_degree)
+        arrays["transitive_in_degree"] = numpy.array(stats.transitive_in_degree)
+        arrays["direct_in_degree_tu"] = numpy.array(stats.direct_in_degree_tu)
+        arrays["transitive_in_degree_tu"] = numpy.array(stats.transitive_in_degree_tu)
+        arrays["statistics"] = numpy.array(json.dumps(statistics_summary(stats, analysis.labels)))
+    if "costs" in sections:
+        costs = analysis.costs()
+        arrays["including_tus"] = numpy.array(costs.including_tus)
+        arrays["cost_tus"] = numpy.array(costs.tus, dtype=numpy.int64)
+        for name in costs.metrics:
+            arrays[name] = numpy.array(costs.metrics[name], dtype=numpy.int64)
+            arrays["attributed_" + name] = numpy.array(costs.attributed[name], dtype=numpy.int64)
+            # in the order of cost_tus
+            arrays["preprocessed_" + name] = numpy.array(costs.preprocessed[name], dtype=numpy.int64)
+    numpy.savez_compressed(path, **arrays)
+
+# Shards
+# A shard analyzes every n-th translation unit and writes what it learned: the parse result of every
+# file it visited and, for every context the file was processed in, where each of its active includes
+# resolved to, which are the direct edges, or null for unresolved includes. Merging replays the depth-first traversal of
+# a single run over all translation units in compile_commands order with these results, parsed files
+# and resolved includes come from the shards so the files are only read again where the traversal
+# needs something no shard saw. Node numbering, edges and everything computed from them are the same
+# as for a single run.
+shard_format_version = 3
+
+def shard_argument(string):
+    index, _, count = string.partition("/")
+    if not (index.isdigit() and count.isdigit() and int(index) < int(count)):
+        raise argparse.ArgumentTypeError(f"Invalid shard {string}, expected I/N with 0 <= I < N")
+    return int(index), int(count)
+
+def open_data_file(path: str, mode: str):
+    # shards and snapshots are json, compressed if the file name ends in .gz
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+def shard_record(analysis: Analysis, shard: tuple, compile_commands: str) -> dict:
+    search_path_sets = {} # search paths -> index
+    def search_path_index(search_paths) -> int:
+        return search_path_sets.setdefault(tuple(search_paths), len(search_path_sets))
+    contexts = {} # (search paths, macros) -> index
+    def context_index(context: tuple) -> int:
+        return contexts.setdefault(context, len(contexts))
+    nodes = []
+    for path in analysis.visited:
+        nodes.append({
+            "path": path,
+            "result": analysis.parsed[path],
+            # includes were looked up while processing the file, these are memo hits
+            "contexts": [
+                [context_index(context), [analysis.find_include(path, include, context[0]) for include in analysis.active_includes(path, context[1])]]
+                for context in analysis.file_contexts[path]
+            ]
+        })
+    units = [[path, search_path_index(search_paths), defines] for path, search_paths, defines in analysis.units]
+    return {
+        "version": shard_format_version,
+        "shard": list(shard),
+        "compile_commands": compile_commands,
+        "parse": analysis.parse.__name__,
+        "excludes": analysis.excludes,
+        "sentinels": analysis.sentinels,
+        "predefined_macros": analysis.predefined_macros,
+        "search_paths": [list(search_paths) for search_paths in search_path_sets],
+        "contexts": [[search_path_index(search_paths), macros] for search_paths, macros in contexts],
+        "translation_units": units,
+        "nodes": nodes,
+        "not_found": sorted(analysis.not_found),
+        "sentinel_nodes": [label for label in analysis.nodes if label not in analysis.visited]
+    }
+
+def write_shard(analysis: Analysis, shard: tuple, compile_commands: str, path: str = None):
+    record = shard_record(analysis, shard, compile_commands)
+    with (open_data_file(path, "w") if path is not None else contextlib.nullcontext(sys.stdout)) as out:
+        json.dump(record, out, separators=(",", ":"))
+        out.write("\n")
+
+def read_shard(path: str) -> dict:
+    with open_data_file(path, "r") as f:
+        record = json.load(f)
+    if record.get("version") != shard_format_version:
+        raise RuntimeError("{} is not a shard of this version".format(path))
+    return record
+
+def merge_shards(shards: list) -> Analysis:
+    # shards are records from read_shard, together they have to cover every index of one shard count
+    first = shards[0]
+    for key in ("compile_commands", "parse", "excludes", "sentinels", "predefined_macros"):
+        for shard in shards:
+            if shard[key] != first[key]:
+                raise RuntimeError("Shards differ in {}: {} and {}".format(key, first[key], shard[key]))
+    count = first["shard"][1]
+    indices = sorted(shard["shard"][0] for shard in shards)
+    if any(shard["shard"][1] != count for shard in shards) or indices != list(range(count)):
+        raise RuntimeError("Expected shards 0/{0} to {1}/{0}, got {2}".format(
+            count, count - 1, ", ".join("{}/{}".format(*shard["shard"]) for shard in shards)
+        ))
+    shards = sorted(shards, key=lambda shard: shard["shard"][0])
+    parsers = {parse.__name__: parse for parse in (parse_includes, scan_includes, verify_scan)}
+    analysis = Analysis(first["excludes"], first["sentinels"], parsers[first["parse"]])
+    analysis.predefined_macros = first["predefined_macros"]
+    units = []
+    for shard in shards:
+        search_path_sets = [tuple(search_paths) for search_paths in shard["search_paths"]]
+        contexts = [
+            (search_path_sets[k], dict(macros) if macros is not None else None)
+            for k, macros in shard["contexts"]
+        ]
+        for node in shard["nodes"]:
+            path = node["path"]
+            analysis.parsed.setdefault(path, node["result"])
+            directory = os.path.dirname(path)
+            for k, found_includes in node["contexts"]:
+                search_paths, macros = contexts[k]
+                includes = active_includes(node["result"], macros) if macros is not None else node["result"]["includes"]
+                for include, found in zip(includes, found_includes):
+                    analysis.resolver.memo.setdefault((directory, include, search_paths), (found, 0))
+        units.append([
+            (path, search_path_sets[i], tuple(tuple(define) for define in defines))
+            for path, i, defines in shard["translation_units"]
+        ])
+    # shard i has the translation units i, i + count, i + 2 * count, ...
+    for position in range(max(len(shard_units) for shard_units in units)):
+        for shard_units in units:
+            if position < len(shard_units):
+                path, search_paths, defines = shard_units[position]
+                print("From compile commands:", path)
+                analysis.process_translation_unit(path, search_paths, defines)
+    print("missed:", analysis.not_found)
+    analysis.resolver.print_stats()
+    return analysis
+
+# Snapshots
+# A snapshot keeps what a before/after comparison needs: the paths, the direct edges in CSR form and
+# the per-node counts and cycles of the statistics, but not the closure. diff_snapshots compares two
+# of them. Edges, counts and cycles are compared directly. Closure rows can only differ for files
+# which reach a file whose edges changed, in the old or in the new graph, so only those rows are
+# expanded, from lazy closures of both graphs: the work grows with the reach of the change, not N^2.
+snapshot_format_version = 1
+
+def snapshot_record(analysis: Analysis) -> dict:
+    stats = analysis.statistics()
+    return {
+        "version": snapshot_format_version,
+        "labels": analysis.labels,
+        "translation_units": [i for i, is_tu in enumerate(analysis.is_tu) if is_tu],
+        "edge_offsets": list(analysis.graph.offsets),
+        "edge_targets": list(analysis.graph.targets),
+        "direct_in_degree": stats.direct_in_degree,
+        "transitive_in_degree": stats.transitive_in_degree,
+        "transitive_in_degree_tu": stats.transitive_in_degree_tu,
+        "cycles": stats.cycles
+    }
+
+def write_snapshot(analysis: Analysis, path: str):
+    with open_data_file(path, "w") as out:
+        json.dump(snapshot_record(analysis), out, separators=(",", ":"))
+        out.write("\n")
+
+def read_snapshot(path: str) -> dict:
+    with open_data_file(path, "r") as f:
+        snapshot = json.load(f)
+    if snapshot.get("version") != snapshot_format_version:
+        raise RuntimeError("{} is not a snapshot of this version".format(path))
+    offsets, targets = snapshot["edge_offsets"], snapshot["edge_targets"]
+    snapshot["graph"] = Graph(targets[offsets[i] : offsets[i + 1]] for i in range(len(offsets) - 1))
+    return snapshot
+
+def reverse_reachable(graph: Graph, nodes: set) -> set:
+    # nodes which reach one of nodes, including nodes themselves
+    reverse = [[] for _ in range(len(graph))]
+    for i, successors in enumerate(graph):
+        for j in successors:
+            reverse[j].append(i)
+    found = set(nodes)
+    stack = list(nodes)
+    while stack:
+        for p in reverse[stack.pop()]:
+            if p not in found:
+                found.add(p)
+                stack.append(p)
+    return found
+
+def reachable_subgraph(graph: Graph, roots: set):
+    # the nodes reachable from roots, roots included, and the graph between them in local numbering
+    nodes = list(roots)
+    local = {node: k for k, node in enumerate(nodes)}
+    k = 0
+    while k < len(nodes):
+        for j in graph[nodes[k]]:
+            if j not in local:
+                local[j] = len(nodes)
+                nodes.append(j)
+        k += 1
+    return nodes, local, Graph([local[j] for j in graph[node]] for node in nodes)
+
+def diff_snapshots(old: dict, new: dict, closure_cache: int = 256 << 20) -> dict:
+    old_labels, new_labels = old["labels"], new["labels"]
+    new_index = {label: i for i, label in enumerate(new_labels)}
+    old_to_new = [new_index.get(label, -1) for label in old_labels]
+    old_graph, new_graph = old["graph"], new["graph"]
+    same_labels = old_labels == new_labels
+    added_edges = []
+    removed_edges = []
+    changed_old = set() # nodes whose direct dependencies changed, in both numberings
+    changed_new = set()
+    def add_change(i: int, j: int):
+        before = {old_labels[k] for k in old_graph[i]} if i != -1 else set()
+        after = {new_labels[k] for k in new_graph[j]} if j != -1 else set()
+        label = old_labels[i] if i != -1 else new_labels[j]
+        added_edges.extend([label, target] for target in sorted(after - before))
+        removed_edges.extend([label, target] for target in sorted(before - after))
+        if i != -1:
+            changed_old.add(i)
+        if j != -1:
+            changed_new.add(j)
+    for i, j in enumerate(old_to_new):
+        if same_labels:
+            if old_graph[i] != new_graph[i]:
+                add_change(i, i)
+        elif j == -1 or sorted(old_to_new[k] for k in old_graph[i]) != list(new_graph[j]):
+            add_change(i, j)
+    new_nodes = [] if same_labels else sorted(set(range(len(new_labels))) - set(old_to_new))
+    for j in new_nodes:
+        add_change(-1, j)
+    # only the rows of nodes reaching a changed node can differ, they're computed over the part of
+    # each graph they reach
+    affected = {old_labels[i] for i in reverse_reachable(old_graph, changed_old)} if changed_old else set()
+    if changed_new:
+        affected |= {new_labels[j] for j in reverse_reachable(new_graph, changed_new)}
+    old_index = {label: i for i, label in enumerate(old_labels)} if affected else {}
+    def rows(labels: list, index: dict, graph: Graph) -> dict:
+        roots = {index[label] for label in affected if label in index}
+        nodes, local, subgraph = reachable_subgraph(graph, roots)
+        closure = LazyClosure(subgraph, closure_cache)
+        return lambda label: {labels[nodes[k]] for k in iter_bits(closure.row(local[index[label]]))} if label in index else set()
+    closure = []
+    closure_added = 0
+    closure_removed = 0
+    if affected:
+        old_row = rows(old_labels, old_index, old_graph)
+        new_row = rows(new_labels, new_index, new_graph)
+        for label in sorted(affected):
+            before = old_row(label)
+            after = new_row(label)
+            if before != after:
+                closure.append({"file": label, "added": sorted(after - before), "removed": sorted(before - after)})
+                closure_added += len(after - before)
+                closure_removed += len(before - after)
+    old_cycles = {frozenset(old_labels[i] for i in cycle) for cycle in old["cycles"]}
+    new_cycles = {frozenset(new_labels[i] for i in cycle) for cycle in new["cycles"]}
+    # translation units which have to be rebuilt when a header changes
+    old_tus = set(old["translation_units"])
+    new_tus = set(new["translation_units"])
+    old_counts = old["transitive_in_degree_tu"]
+    new_counts = new["transitive_in_degree_tu"]
+    tu_counts = []
+    def add_count(i: int, j: int):
+        if (i != -1 and i in old_tus) or (j != -1 and j in new_tus):
+            return
+        before = old_counts[i] if i != -1 else 0
+        after = new_counts[j] if j != -1 else 0
+        if before != after:
+            tu_counts.append({"file": old_labels[i] if i != -1 else new_labels[j], "old": before, "new": after})
+    for i, j in enumerate(old_to_new):
+        if j == -1 or old_counts[i] != new_counts[j]:
+            add_count(i, j)
+    for j in new_nodes:
+        add_count(-1, j)
+    tu_counts.sort(key=lambda change: (-abs(change["new"] - change["old"]), change["file"]))
+    return {
+        "added_files": sorted(new_labels[j] for j in new_nodes),
+        "removed_files": sorted(old_labels[i] for i, j in enumerate(old_to_new) if j == -1),
+        "added_edges": sorted(added_edges),
+        "removed_edges": sorted(removed_edges),
+        "closure_added": closure_added,
+        "closure_removed": closure_removed,
+        "closure": closure,
+        "new_cycles": sorted(sorted(cycle) for cycle in new_cycles - old_cycles),
+        "removed_cycles": sorted(sorted(cycle) for cycle in old_cycles - new_cycles),
+        "tu_counts": tu_counts
+    }
+
+def diff_grew(diff: dict) -> bool:
+    # whether a change added dependencies or cycles or made a header reach more translation units
+    return bool(diff["added_edges"] or diff["closure_added"] or diff["new_cycles"]
+                or any(change["new"] > change["old"] for change in diff["tu_counts"]))
+
+def print_diff(diff: dict, out=sys.stdout, top: int = 20):
+    def print_list(title: str, items: list, indent: str = "    "):
+        if not items:
+            return
+        out.write("{}{} ({}):\n".format(indent[4:], title, len(items)))
+        for item in items[:top]:
+            out.write("{}{}\n".format(indent, item))
+        if len(items) > top:
+            out.write("{}... and {} more\n".format(indent, len(items) - top))
+    print_list("Added files", diff["added_files"])
+    print_list("Removed files", diff["removed_files"])
+    print_list("Added includes", ["{} -> {}".format(*edge) for edge in diff["added_edges"]])
+    print_list("Removed includes", ["{} -> {}".format(*edge) for edge in diff["removed_edges"]])
+    if diff["closure"]:
+        out.write("Transitive dependencies: {} added, {} removed in {} files\n".format(
+            diff["closure_added"], diff["closure_removed"], len(diff["closure"])
+        ))
+        for change in diff["closure"][:top]:
+            out.write("    {}\n".format(change["file"]))
+            print_list("added", change["added"], " " * 12)
+            print_list("removed", change["removed"], " " * 12)
+        if len(diff["closure"]) > top:
+            out.write("    ... and {} more\n".format(len(diff["closure"]) - top))
+    print_list("New cycles", [" ".join(os.path.basename(label) for label in cycle) for cycle in diff["new_cycles"]])
+    print_list("Removed cycles", [" ".join(os.path.basename(label) for label in cycle) for cycle in diff["removed_cycles"]])
+    print_list("Translation units including headers", [
+        "{:+6} {:>6} -> {:<6} {}".format(change["new"] - change["old"], change["old"], change["new"], change["file"])
+        for change in diff["tu_counts"]
+    ])
+    if not any(diff[key] for key in ("added_files", "removed_files", "added_edges", "removed_edges", "closure", "new_cycles", "removed_cycles", "tu_counts")):
+        out.write("No dependency changes\n")
+
+class Watcher:
+    # Keeps an analysis up to date while files change and answers queries about it. Files are polled
+    # by mtime; changed files are parsed again and only the affected closure rows are recomputed. A
+    # change to compile_commands.json which only adds translation units is applied incrementally too,
+    # anything else triggers a full re-analysis through rebuild().
+    def __init__(self, analysis: Analysis, compile_commands: str, entries: list, rebuild):
+        self.analysis = analysis
+        self.compile_commands = compile_commands
+        self.entries = entries
+        self.rebuild = rebuild
+        self.mtimes = {}
+        self.snapshot()
+
+    def mtime(self, path: str):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    def snapshot(self):
+        # Directories are polled too: a header created in a search path or next to an includer can
+        # resolve an include which wasn't found, their mtime changes when it's created.
+        directories = set()
+        for path in self.analysis.visited:
+            if path not in self.mtimes:
+                self.mtimes[path] = self.mtime(path)
+            directories.add(os.path.dirname(path))
+        for _, search_paths, _ in self.analysis.units:
+            directories.update(search_paths)
+        for path in directories:
+            if path not in self.mtimes:
+                self.mtimes[path] = self.mtime(path)
+        if self.compile_commands not in self.mtimes:
+            self.mtimes[self.compile_commands] = self.mtime(self.compile_commands)
+
+    def poll(self) -> bool:
+        # An mtime is only advanced once the change was applied, a file which couldn't be parsed is
+        # tried again at the next poll.
+        start = time.perf_counter()
+        changed = {}
+        for path, mtime in self.mtimes.items():
+            current = self.mtime(path)
+            if current != mtime:
+                changed[path] = current
+        if not changed:
+            return False
+        new_units = []
+        entries = None
+        if self.compile_commands in changed:
+            entries = load_compile_commands(self.compile_commands)
+            if entries[:len(self.entries)] != self.entries or any(entry[0] in self.analysis.nodes for entry in entries[len(self.entries):]):
+                print("compile commands changed, rebuilding")
+                try:
+                    analysis = self.rebuild()
+                except Exception as e:
+                    print("error: not rebuilt: {}".format(e), file=sys.stderr)
+                    return True
+                self.analysis = analysis
+                self.entries = entries
+                self.mtimes = {}
+                self.snapshot()
+                print("rebuilt in {:.1f}ms".format(1000 * (time.perf_counter() - start)))
+                return True
+            new_units = entries[len(self.entries):]
+        files = [path for path in changed if path != self.compile_commands]
+        nodes = self.analysis.update(files, new_units)
+        if self.analysis.cache is not None:
+            self.analysis.cache.commit()
+        failed = self.analysis.failed
+        for path in files:
+            if path not in failed:
+                self.mtimes[path] = changed[path]
+        # new translation units which couldn't be added are added again with the next change
+        if entries is not None and not any(path in failed for path, _, _ in new_units):
+            self.entries = entries
+            self.mtimes[self.compile_commands] = changed[self.compile_commands]
+        self.snapshot()
+        print("{} files changed, {} nodes updated in {:.1f}ms".format(len(changed), nodes, 1000 * (time.perf_counter() - start)))
+        return True
+
+    def query(self, line: str) -> str:
+        return json.dumps(answer_query(self.analysis, line))
+
+    def serve(self, interval: float, socket_path: str = None):
+        # Answers queries from stdin and, optionally, a unix socket while polling for changes. Progress
+        # messages go to stderr so stdout only carries answers.
+        selector = selectors.DefaultSelector()
+        buffers = {}
+        stdin = sys.stdin.fileno()
+        selector.register(stdin, selectors.EVENT_READ)
+        buffers[stdin] = b""
+        server = None
+        if socket_path is not None:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            server.bind(socket_path)
+            server.listen()
+            selector.register(server, selectors.EVENT_READ)
+        next_poll = time.monotonic() + interval
+        try:
+            while True:
+                for key, _ in selector.select(max(0, next_poll - time.monotonic())):
+                    if key.fileobj is server:
+                        connection, _ = server.accept()
+                        selector.register(connection, selectors.EVENT_READ)
+                        buffers[connection] = b""
+                        continue
+                    if key.fileobj == stdin:
+                        data = os.read(stdin, 65536)
+                    else:
+                        data = key.fileobj.recv(65536)
+                    if not data:
+                        selector.unregister(key.fileobj)
+                        del buffers[key.fileobj]
+                        if key.fileobj == stdin:
+                            if server is None:
+                                return
+                        else:
+                            key.fileobj.close()
+                        continue
+                    *lines, buffers[key.fileobj] = (buffers[key.fileobj] + data).split(b"\n")
+                    answers = "".join(self.query(line.decode()) + "\n" for line in lines if line.strip())
+                    if key.fileobj == stdin:
+                        sys.stdout.write(answers)
+                        sys.stdout.flush()
+                    else:
+                        key.fileobj.sendall(answers.encode())
+                if time.monotonic() >= next_poll:
+                    with contextlib.redirect_stdout(sys.stderr):
+                        self.poll()
+                    next_poll = time.monotonic() + interval
+        finally:
+            if server is not None:
+                server.close()
+                os.remove(socket_path)
+
+# Profiling
+# With --profile the hot functions are replaced by timing wrappers, without it nothing is wrapped
+# so there is no overhead. Time spent in nested instrumented calls is subtracted to get self time,
+# total time only counts the outermost call when a function is called from itself.
+class Profiler:
+    def __init__(self, trace: bool = False, slowest: int = 20):
+        self.origin = time.perf_counter()
+        self.spans = {} # name -> [calls, total seconds, self seconds]
+        self.active = collections.Counter() # name -> number of calls currently running
+        self.children = [] # stack of time spent in instrumented callees of the running calls
+        self.counters = collections.Counter()
+        self.slowest = slowest
+        self.files = [] # min-heap of (seconds, path) for the slowest parsed files
+        self.events = [] if trace else None
+
+    def wrap(self, function, name: str, per_file: bool = False):
+        # per_file: the first argument is a path, track the slowest calls
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            self.active[name] += 1
+            self.children.append(0)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                self.active[name] -= 1
+                children = self.children.pop()
+                if self.children:
+                    self.children[-1] += elapsed
+                span = self.spans.setdefault(name, [0, 0, 0])
+                span[0] += 1
+                span[2] += elapsed - children
+                if self.active[name] == 0:
+                    span[1] += elapsed
+                if per_file:
+                    heapq.heappush(self.files, (elapsed, args[0]))
+                    if len(self.files) > self.slowest:
+                        heapq.heappop(self.files)
+                if self.events is not None:
+                    event = {
+                        "name": name,
+                        "ph": "X",
+                        "ts": (start - self.origin) * 1e6,
+                        "dur": elapsed * 1e6,
+                        "pid": 0,
+                        "tid": 0
+                    }
+                    path = next((arg for arg in args[:2] if isinstance(arg, str)), None)
+                    if path is not None:
+                        event["args"] = {"path": path}
+                    self.events.append(event)
+        return wrapper
+
+    def count_bytes(self, function):
+        # counted per parse, verify_scan reads each file twice but it's still one file's bytes
+        @functools.wraps(function)
+        def wrapper(path: str):
+            result = function(path)
+            self.counters["bytes read"] += result["size"]
+            return result
+        return wrapper
+
+    def instrument(self):
+        # Module level functions are looked up by name when called, so replacing them in globals()
+        # is enough. Wrappers keep the wrapped function's name so they can still be pickled for -j,
+        # but time spent parsing in worker processes isn't measured.
+        module = globals()
+        for name in ("parse_includes", "scan_includes", "verify_scan"):
+            module[name] = self.wrap(self.count_bytes(module[name]), "parse", per_file=True)
+        for name in ("build_matrix", "resolve_include", "active_includes", "process_file", "prefetch", "statistics", "update"):
+            setattr(Analysis, name, self.wrap(getattr(Analysis, name), "Analysis." + name))
+        for name in ("print_graphviz", "print_matrix", "print_statistics", "write_text", "write_json", "write_ndjson", "write_sqlite", "write_npz"):
+            module[name] = self.wrap(module[name], name)
+        lex = module["phase_three"]
+        def phase_three(string):
+            for token in lex(string):
+                self.counters["tokens"] += 1
+                yield token
+        module["phase_three"] = phase_three
+
+    def summary(self, analysis: Analysis) -> dict:
+        counters = dict(self.counters)
+        if analysis is not None:
+            counters["files visited"] = len(analysis.visited)
+            counters["include lookups"] = analysis.resolver.lookups
+            counters["stat calls"] = analysis.resolver.stat_calls
+            counters["directory listings"] = analysis.resolver.listdir_calls
+            if analysis.cache is not None:
+                counters["cache hits"] = analysis.cache.hits
+                counters["cache misses"] = analysis.cache.misses
+        return {
+            "seconds": time.perf_counter() - self.origin,
+            "spans": {
+                name: {"calls": calls, "total": total, "self": self_time}
+                for name, (calls, total, self_time) in sorted(self.spans.items(), key=lambda item: -item[1][2])
+            },
+            "counters": counters,
+            "slowest files": [{"path": path, "seconds": seconds} for seconds, path in sorted(self.files, reverse=True)]
+        }
+
+    def write(self, analysis: Analysis, path: str, trace_path: str = None):
+        with open(path, "w") as f:
+            json.dump(self.summary(analysis), f, indent=4)
+        if trace_path is not None:
+            with open(trace_path, "w") as f:
+                json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+
+def init_worker(encodings: list):
+    # output from worker processes would interleave arbitrarily, the coordinator prints the traversal
+    sys.stdout = open(os.devnull, "w")
+    source_encodings[:] = encodings
+
+# include directory flags, in the order the compiler searches the directories
+search_path_flags = ("-iquote", "-I", "-isystem")
+# a flag and its value, which is a shell word that may be quoted or escaped in parts
+command_search_path_regex = re.compile(r"""(?:^|\s)(-iquote|-isystem|-I)\s*((?:"(?:\\.|[^"\\])*"|'[^']*'|\\.|[^\s"'\\])+)""")
+
+def shell_word(word: str) -> str:
+    # removes the quotes and backslash escapes of a word matched in a "command", shlex.split
+    # wouldn't change a word without them
+    if "\"" in word or "'" in word or "\\" in word:
+        return shlex.split(word)[0]
+    return word
+
+def parse_search_paths(arguments) -> list:
+    # arguments is either the "command" string or the "arguments" list of a compile_commands entry
+    paths = {flag: [] for flag in search_path_flags}
+    if isinstance(arguments, str):
+        for m in command_search_path_regex.finditer(arguments):
+            paths[m.group(1)].append(shell_word(m.group(2)))
+    else:
+        arguments = iter(arguments)
+        for argument in arguments:
+            for flag in search_path_flags:
+                if argument.startswith(flag):
+                    path = argument[len(flag):] or next(arguments, "")
+                    if path:
+                        paths[flag].append(path)
+                    break
     # print("Search paths:", paths)
-    return paths
+    return [path for flag in search_path_flags for path in paths[flag]]
+
+# -D and -U with their value, like search path flags
+command_macro_regex = re.compile(r"""(?:^|\s)-([DU])\s*((?:"(?:\\.|[^"\\])*"|'[^']*'|\\.|[^\s"'\\])+)""")
+
+def macro_definition(flag: str, word: str) -> tuple:
+    # (name, value) for -Dname, -Dname=value or -Uname, see the macros dicts of active_includes
+    if flag == "U":
+        return word, False
+    name, equals, value = word.partition("=")
+    if "(" in name:
+        return name[:name.index("(")], None
+    return name, " ".join(directive_tokens(value)) if equals else "1"
+
+def parse_macros(arguments) -> list:
+    # the (name, value) of every -D and -U of a compile_commands entry in order, later ones win
+    macros = []
+    if isinstance(arguments, str):
+        for m in command_macro_regex.finditer(arguments):
+            macros.append(macro_definition(m.group(1), shell_word(m.group(2))))
+    else:
+        arguments = iter(arguments)
+        for argument in arguments:
+            if argument[:2] in ("-D", "-U"):
+                word = argument[2:] or next(arguments, "")
+                if word:
+                    macros.append(macro_definition(argument[1], word))
+    return macros
+
+json_whitespace_regex = re.compile(r"[ \t\n\r]*")
+
+def iter_json_array(f, chunk_size: int = 1 << 20):
+    # Yields the elements of the json array in f one at a time, reading chunk_size characters at a
+    # time, so memory use doesn't grow with the size of the file.
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    offset = 0 # position of buffer in the file
+    eof = False
+    state = "start" # start, first (element or ]), separator (, or ]), element
+    while True:
+        pos = json_whitespace_regex.match(buffer, pos).end()
+        need_more = pos == len(buffer)
+        if not need_more:
+            c = buffer[pos]
+            if state == "start":
+                if c != "[":
+                    raise Exception("expected a json array in {}".format(f.name))
+                pos += 1
+                state = "first"
+                continue
+            if state in ("first", "separator") and c == "]":
+                return
+            if state == "separator":
+                if c != ",":
+                    raise Exception("expected , or ] at offset {} in {}".format(offset + pos, f.name))
+                pos += 1
+                state = "element"
+                continue
+            try:
+                value, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError as e:
+                if eof:
+                    raise Exception("invalid json at offset {} in {}: {}".format(offset + e.pos, f.name, e.msg))
+                end = None
+            # an element ending at the end of the buffer might continue in the next chunk
+            need_more = end is None or (end == len(buffer) and not eof)
+            if not need_more:
+                yield value
+                pos = end
+                state = "separator"
+                continue
+        if eof:
+            raise Exception("unexpected end of {}".format(f.name))
+        chunk = f.read(chunk_size)
+        eof = not chunk
+        buffer = buffer[pos:] + chunk
+        offset += pos
+        pos = 0
+
+def iter_compile_commands(path: str):
+    # Yields (absolute path, search paths, defines) for every entry of a compile_commands.json while
+    # reading it, defines as returned by parse_macros. Paths are resolved relative to the entry's
+    # directory. Identical search path lists and defines are shared as one tuple. A file compiled more
+    # than once with different flags (per-target builds) is yielded for each of them, it's processed
+    # in every context, exact duplicates are only yielded once.
+    interned = {} # (directory, search paths as written) -> absolute search paths
+    search_path_sets = {}
+    define_sets = {}
+    seen = set() # (absolute path, search paths, defines)
+    with open(path, "r", encoding="utf-8") as f:
+        for entry in iter_json_array(f):
+            directory = entry["directory"]
+            file = os.path.abspath(os.path.join(directory, entry["file"]))
+            arguments = entry["arguments"] if "arguments" in entry else entry["command"]
+            key = (directory, tuple(parse_search_paths(arguments)))
+            if key not in interned:
+                search_paths = tuple(os.path.abspath(os.path.join(directory, search_path)) for search_path in key[1])
+                interned[key] = search_path_sets.setdefault(search_paths, search_paths)
+            defines = tuple(parse_macros(arguments))
+            defines = define_sets.setdefault(defines, defines)
+            if (file, interned[key], defines) in seen:
+                continue
+            seen.add((file, interned[key], defines))
+            yield file, interned[key], defines
 
 def file_path(string):
     if os.path.isfile(string):
@@ -447,24 +3159,27 @@ def dir_path(string):
     else:
         raise RuntimeError(f"Invalid directory {string}")
 
-def main():
-    parser = argparse.ArgumentParser(
-        prog="cpp-dependency-analyzer",
-        description="Analyze C++ transitive dependencies"
-    )
-    parser.add_argument(
-        "--compile-commands",
-        type=file_path,
-        required=True
-    )
-    # parser.add_argument(
-    #     "--pwd",
-    #     type=dir_path,
-    # )
-    parser.add_argument('--exclude', action='append', nargs=1)
-    parser.add_argument('--sentinel', action='append', nargs=1)
-    args = parser.parse_args()
+def load_compile_commands(path: str) -> list:
+    return list(iter_compile_commands(path))
+
+def analyze(compile_commands: str, excludes: list = None, sentinels: list = None, parse=parse_includes, cache: ParseCache = None, closure_cache: int = None, platform: str = None) -> Analysis:
+    # Analyzes a project when used as a library, progress output is discarded:
+    #     analysis = analyze("build/compile_commands.json")
+    #     analysis.queries().impact("include/foo.h")
+    # excludes are absolute paths, directories ending in a path separator. closure_cache in bytes
+    # makes the closure lazy, see LazyClosure. With a platform from platform_macros conditionals are
+    # evaluated. parse is parse_includes like on the command line, scan_includes is faster.
+    analysis = Analysis(excludes if excludes is not None else [], sentinels if sentinels is not None else [], parse, cache)
+    analysis.closure_cache = closure_cache
+    if platform is not None:
+        analysis.predefined_macros = platform_macros[platform]
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for path, search_paths, defines in iter_compile_commands(os.path.abspath(compile_commands)):
+            analysis.process_translation_unit(path, search_paths, defines)
+        analysis.build_matrix()
+    return analysis
 
+def run_analysis(args, cache: ParseCache = None) -> Analysis:
     excludes = []
     if args.exclude:
         # print(args.exclude)
@@ -482,16 +3197,35 @@ def main():
     # if args.pwd:
     #     os.chdir(args.pwd)
 
-    with open(args.compile_commands, "r") as f:
-        compile_commands = json.load(f)
+    entries = iter_compile_commands(args.compile_commands)
+    if getattr(args, "shard", None) is not None:
+        # every count-th translation unit starting at index
+        index, count = args.shard
+        entries = itertools.islice(entries, index, None, count)
+
+    if args.verify_scan:
+        parse = verify_scan
+    elif args.fast_scan:
+        parse = scan_includes
+    else:
+        parse = parse_includes
+    if cache is None and args.cache_dir:
+        cache = ParseCache(os.path.abspath(args.cache_dir), args.cache_max_entries, args.cache_hash)
+    resolver = IncludeResolver(args.index_search_paths)
+    analysis = Analysis(excludes, sentinels, parse, cache, resolver)
+    if args.closure_cache is not None:
+        analysis.closure_cache = int(args.closure_cache * 2**20)
+    if args.conditionals:
+        analysis.predefined_macros = platform_macros[args.platform]
 
-    analysis = Analysis(excludes, sentinels)
+    if args.jobs > 1:
+        # the prefetch needs all roots up front
+        entries = list(entries)
+        analysis.prefetch(entries, args.jobs)
 
-    for entry in compile_commands:
-        os.chdir(entry["directory"])
-        print("From compile commands:", entry["file"])
-        # entry["command"] ...
-        analysis.process_file(os.path.abspath(entry["file"]), parse_search_paths(entry["command"]))
+    for path, search_paths, defines in entries:
+        print("From compile commands:", path)
+        analysis.process_translation_unit(path, search_paths, defines)
 
     # init_lexer()
     # p = Processor(root)
@@ -501,53 +3235,379 @@ def main():
     #print("all: ", p.all_files)
     # print("xor: ", p.all_files ^ p.visited)
     print("missed:", analysis.not_found)
-    for key in analysis.nodes:
-        print("{:20} {}".format(key, analysis.nodes[key]))
-    print()
-
-    analysis.build_matrix()
-
-    labels = [k for k in analysis.nodes.keys()]
-    print_graphviz(analysis, labels)
-    print_header(analysis.matrix, labels)
-    print_matrix(analysis.matrix, labels)
-    print_header(analysis.matrix_closure, labels)
-    print_matrix(analysis.matrix_closure, labels)
-    print("translation units: {}".format(len(compile_commands)))
-    print("direct density: {:.0f}%".format(100 * sum([sum(row) for row in analysis.matrix]) / len(analysis.matrix)**2))
-    print("indirect density: {:.0f}%".format(100 * sum([sum(row) for row in analysis.matrix_closure]) / len(analysis.matrix_closure)**2))
-    cycles = 0
-    for i in range(len(analysis.matrix_closure)):
-        if analysis.matrix_closure[i][i]:
-            cycles += 1
-    print("cyclic dependencies: {}".format("yes" if cycles > 0 else "no"))
-    print()
-    print()
-
-    matrix_counts = count_incident_edges(analysis.matrix, labels)
-    print("Dependency counts:")
-    for name, count in sorted(matrix_counts.items(), key=lambda x: x[1], reverse=True):
-        print(os.path.basename(name), count)
-
-    print()
-    print()
-    matrix_closure_counts = count_incident_edges(analysis.matrix_closure, labels)
-    print("Transitive dependency counts:")
-    for name, count in sorted(matrix_closure_counts.items(), key=lambda x: x[1], reverse=True):
-        print(os.path.basename(name), count)
-
-    print()
-    print()
-    matrix_counts = count_incident_edges(analysis.matrix, labels, True)
-    print("Dependency counts (TU-only):")
-    for name, count in sorted(matrix_counts.items(), key=lambda x: x[1], reverse=True):
-        print(os.path.basename(name), count)
-
-    print()
-    print()
-    matrix_closure_counts = count_incident_edges(analysis.matrix_closure, labels, True)
-    print("Transitive dependency counts (TU-only):")
-    for name, count in sorted(matrix_closure_counts.items(), key=lambda x: x[1], reverse=True):
-        print(os.path.basename(name), count)
-
-main()
+    guards = collections.Counter(analysis.guard(path) for path in analysis.visited if path not in analysis.translation_units)
+    pragma_once, unguarded = guards.pop("#pragma once", 0), guards.pop(None, 0)
+    print("headers: {} with an include guard, {} with #pragma once, {} with neither".format(sum(guards.values()), pragma_once, unguarded))
+    if cache is not None:
+        cache.commit()
+        cache.print_stats()
+    resolver.print_stats()
+    return analysis
+
+def add_closure_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--closure-cache",
+        type=float,
+        metavar="MB",
+        help="compute closure rows on demand and keep at most this many megabytes of them, "
+             + "instead of computing the whole closure up front"
+    )
+
+def add_analysis_arguments(parser: argparse.ArgumentParser):
+    # options for reading and parsing the project, shared by all commands
+    parser.add_argument(
+        "--compile-commands",
+        type=file_path,
+        required=True
+    )
+    # parser.add_argument(
+    #     "--pwd",
+    #     type=dir_path,
+    # )
+    parser.add_argument('--exclude', action='append', nargs=1)
+    parser.add_argument('--sentinel', action='append', nargs=1)
+    parser.add_argument(
+        "--fast-scan",
+        action="store_true",
+        help="only scan preprocessing directives instead of tokenizing every file"
+    )
+    parser.add_argument(
+        "--verify-scan",
+        action="store_true",
+        help="run both the fast scanner and the full parser on every file and fail on any difference"
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        help="directory for the persistent parse cache, files which haven't changed aren't parsed again"
+    )
+    parser.add_argument(
+        "--cache-max-entries",
+        type=int,
+        default=200000,
+        help="number of files kept in the parse cache, least recently used entries are evicted first"
+    )
+    parser.add_argument(
+        "--cache-hash",
+        action="store_true",
+        help="also validate cache entries against a hash of the file contents"
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=1,
+        help="number of worker processes used to parse files"
+    )
+    parser.add_argument(
+        "--index-search-paths",
+        action="store_true",
+        help="answer include lookups from cached directory listings instead of checking every candidate path"
+    )
+    parser.add_argument(
+        "--conditionals",
+        action="store_true",
+        help="evaluate #if/#ifdef/... with the platform's macros and the -D/-U flags of each compile command, "
+             + "includes in branches which are known to be dead aren't followed"
+    )
+    parser.add_argument(
+        "--platform",
+        choices=list(platform_macros),
+        default=host_platform,
+        help="predefined macros used with --conditionals, the host's by default, none only uses -D/-U"
+    )
+    parser.add_argument(
+        "--source-encoding",
+        type=str,
+        default=",".join(source_encodings),
+        help="comma separated encodings tried in order when decoding source files, utf-8,latin-1 by default"
+    )
+    add_closure_arguments(parser)
+    parser.add_argument(
+        "--profile",
+        type=str,
+        metavar="FILE",
+        help="time the hot paths and write a json summary with timings, counters and the slowest files to FILE"
+    )
+    parser.add_argument(
+        "--profile-trace",
+        type=str,
+        metavar="FILE",
+        help="with --profile, also write a chrome trace (chrome://tracing, perfetto) to FILE"
+    )
+    parser.add_argument(
+        "--profile-slowest",
+        type=int,
+        default=20,
+        help="number of slowest files to list in the profile"
+    )
+
+def prepare_arguments(args):
+    # makes paths absolute and applies global settings, returns the profiler if --profile is given
+    args.compile_commands = os.path.abspath(args.compile_commands)
+    source_encodings[:] = args.source_encoding.split(",")
+    for encoding in source_encodings:
+        codecs.lookup(encoding)
+    profiler = None
+    if args.profile is not None:
+        args.profile = os.path.abspath(args.profile)
+        if args.profile_trace is not None:
+            args.profile_trace = os.path.abspath(args.profile_trace)
+        profiler = Profiler(args.profile_trace is not None, args.profile_slowest)
+        profiler.instrument()
+    return profiler
+
+def finish(analysis: Analysis, args, profiler: Profiler):
+    if isinstance(getattr(analysis, "closure", None), LazyClosure):
+        analysis.closure.print_stats(sys.stderr)
+    if analysis.cache is not None:
+        analysis.cache.close()
+    if profiler is not None:
+        profiler.write(analysis, args.profile, args.profile_trace)
+
+def query_main(argv: list):
+    parser = argparse.ArgumentParser(
+        prog="cpp-dependency-analyzer query",
+        description="Answer dependency queries against one analysis. Each answer is one line of json. Queries: "
+                    + "; ".join("{}: {}".format(" ".join([command] + ["FILE", "FILE2"][:arguments]), description)
+                                for command, (arguments, description) in query_commands.items())
+    )
+    add_analysis_arguments(parser)
+    parser.add_argument(
+        "queries",
+        nargs="*",
+        help="queries like \"impact foo.h\", if none are given they are read from stdin, one per line"
+    )
+    args = parser.parse_args(argv)
+    profiler = prepare_arguments(args)
+    with contextlib.redirect_stdout(sys.stderr):
+        analysis = run_analysis(args)
+        analysis.build_matrix()
+        start = time.perf_counter()
+        analysis.queries()
+        print("query index built in {:.1f}ms".format(1000 * (time.perf_counter() - start)))
+    for line in args.queries or sys.stdin:
+        if line.strip():
+            print(json.dumps(answer_query(analysis, line)), flush=not args.queries)
+    finish(analysis, args, profiler)
+
+def add_report_arguments(parser: argparse.ArgumentParser):
+    # options for the report, shared by main and merge
+    parser.add_argument(
+        "--format",
+        choices=output_formats,
+        default="text",
+        help="output format, text is the human readable report"
+    )
+    parser.add_argument(
+        "--output",
+        "-o",
+        type=str,
+        help="write the output to this file instead of stdout, required for sqlite and npz"
+    )
+    parser.add_argument(
+        "--sections",
+        type=str,
+        help="comma separated list of sections to generate, sections which aren't selected aren't computed. "
+             + "text: {}, other formats: {}".format(",".join(output_sections["text"]), ",".join(output_sections["json"]))
+    )
+    parser.add_argument(
+        "--graphviz-reduce",
+        action="store_true",
+        help="only draw the edges of the transitive reduction instead of all direct dependencies and the closure"
+    )
+    parser.add_argument(
+        "--graphviz-aggregate",
+        choices=["directory", "module"],
+        help="collapse the graphviz nodes by directory or by module (YYY.c/cpp and YYY.h)"
+    )
+    parser.add_argument(
+        "--cost-top",
+        type=int,
+        default=20,
+        help="number of headers and translation units listed in the costs section"
+    )
+    parser.add_argument(
+        "--snapshot",
+        type=str,
+        metavar="FILE",
+        help="also save a snapshot of the graph and its statistics to FILE (compressed if it ends in .gz), for diff"
+    )
+
+def report_sections(args) -> set:
+    # checks the report options and returns the selected sections
+    if args.output is not None:
+        args.output = os.path.abspath(args.output)
+    if args.snapshot is not None:
+        args.snapshot = os.path.abspath(args.snapshot)
+    if args.sections is not None:
+        sections = set(args.sections.split(","))
+        for section in sections:
+            if section not in output_sections[args.format]:
+                raise RuntimeError("Invalid section {} for format {}".format(section, args.format))
+    else:
+        sections = set(default_sections[args.format])
+    if args.format in ("sqlite", "npz") and args.output is None:
+        raise RuntimeError("--format {} requires --output".format(args.format))
+    return sections
+
+def needs_closure(sections: set) -> bool:
+    return len(sections & {"graphviz", "matrix", "counts", "closure", "costs"}) > 0
+
+def write_report(analysis: Analysis, args, sections: set):
+    if args.snapshot is not None:
+        write_snapshot(analysis, args.snapshot)
+    if args.format in ("sqlite", "npz"):
+        (write_sqlite if args.format == "sqlite" else write_npz)(analysis, sections, args.output)
+        return
+    with (open(args.output, "w", buffering=1 << 20) if args.output is not None else contextlib.nullcontext(sys.stdout)) as out:
+        if args.format == "json":
+            write_json(analysis, sections, out)
+        elif args.format == "ndjson":
+            write_ndjson(analysis, sections, out)
+        else:
+            write_text(analysis, sections, out, args.graphviz_reduce, args.graphviz_aggregate, args.cost_top)
+
+def merge_main(argv: list):
+    parser = argparse.ArgumentParser(
+        prog="cpp-dependency-analyzer merge",
+        description="Merge the partial graphs written with --shard into one analysis and write the report, "
+                    + "the result is the same as for a single run over all translation units."
+    )
+    parser.add_argument(
+        "shards",
+        nargs="+",
+        type=file_path,
+        help="shard files, one for every I of --shard I/N"
+    )
+    add_report_arguments(parser)
+    add_closure_arguments(parser)
+    args = parser.parse_args(argv)
+    sections = report_sections(args)
+    progress = sys.stderr if args.format != "text" and args.output is None else sys.stdout
+    with contextlib.redirect_stdout(progress):
+        analysis = merge_shards([read_shard(path) for path in args.shards])
+        if args.closure_cache is not None:
+            analysis.closure_cache = int(args.closure_cache * 2**20)
+        analysis.build_matrix(closure=needs_closure(sections) or args.snapshot is not None)
+    write_report(analysis, args, sections)
+    if isinstance(analysis.closure, LazyClosure):
+        analysis.closure.print_stats(sys.stderr)
+
+def diff_main(argv: list):
+    parser = argparse.ArgumentParser(
+        prog="cpp-dependency-analyzer diff",
+        description="Compare two snapshots written with --snapshot: added and removed includes, transitive "
+                    + "dependencies and cycles and how many translation units include each header."
+    )
+    parser.add_argument("old", type=file_path, help="snapshot before the change")
+    parser.add_argument("new", type=file_path, help="snapshot after the change")
+    parser.add_argument(
+        "--format",
+        choices=["text", "json"],
+        default="text",
+        help="output format"
+    )
+    parser.add_argument(
+        "--top",
+        type=int,
+        default=20,
+        help="number of entries listed per section in the text output"
+    )
+    parser.add_argument(
+        "--fail-on-growth",
+        action="store_true",
+        help="exit with status 1 if includes, transitive dependencies or cycles were added or a header is included by more translation units"
+    )
+    add_closure_arguments(parser)
+    args = parser.parse_args(argv)
+    closure_cache = int(args.closure_cache * 2**20) if args.closure_cache is not None else 256 << 20
+    diff = diff_snapshots(read_snapshot(args.old), read_snapshot(args.new), closure_cache)
+    if args.format == "json":
+        print(json.dumps(diff))
+    else:
+        print_diff(diff, sys.stdout, args.top)
+    if args.fail_on_growth and diff_grew(diff):
+        sys.exit(1)
+
+# subcommands, the first argument selects one, otherwise main runs the report
+commands = {
+    "query": query_main,
+    "merge": merge_main,
+    "diff": diff_main
+}
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] in commands:
+        commands[sys.argv[1]](sys.argv[2:])
+        return
+    parser = argparse.ArgumentParser(
+        prog="cpp-dependency-analyzer",
+        description="Analyze C++ transitive dependencies. Subcommands: {}, see COMMAND --help".format(", ".join(commands))
+    )
+    add_analysis_arguments(parser)
+    add_report_arguments(parser)
+    parser.add_argument(
+        "--shard",
+        type=shard_argument,
+        metavar="I/N",
+        help="only analyze every N-th translation unit starting at I and write a partial graph for merge "
+             + "to --output or stdout instead of the report"
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="after the analysis keep watching files for changes and answer queries from stdin"
+    )
+    parser.add_argument(
+        "--watch-interval",
+        type=float,
+        default=1,
+        help="seconds between checks for changed files in watch mode"
+    )
+    parser.add_argument(
+        "--socket",
+        type=str,
+        help="in watch mode, also answer queries on this unix socket"
+    )
+    args = parser.parse_args()
+    profiler = prepare_arguments(args)
+    sections = report_sections(args)
+    if args.shard is not None and args.watch:
+        raise RuntimeError("--shard can't be used with --watch")
+
+    if args.shard is not None:
+        with contextlib.redirect_stdout(sys.stderr if args.output is None else sys.stdout):
+            analysis = run_analysis(args)
+        write_shard(analysis, args.shard, args.compile_commands, args.output)
+        finish(analysis, args, profiler)
+        return
+
+    # when stdout carries machine readable output or watch mode answers, progress information goes to stderr
+    progress = sys.stderr if (args.format != "text" and args.output is None) or args.watch else sys.stdout
+    with contextlib.redirect_stdout(progress):
+        analysis = run_analysis(args)
+        analysis.build_matrix(closure=args.watch or needs_closure(sections) or args.snapshot is not None)
+
+    if not args.watch or args.output is not None or args.format in ("sqlite", "npz"):
+        write_report(analysis, args, sections)
+    elif args.snapshot is not None:
+        write_snapshot(analysis, args.snapshot)
+
+    if args.watch:
+        def rebuild():
+            with contextlib.redirect_stdout(sys.stderr):
+                rebuilt = run_analysis(args, analysis.cache)
+                rebuilt.build_matrix()
+            return rebuilt
+        watcher = Watcher(analysis, args.compile_commands, load_compile_commands(args.compile_commands), rebuild)
+        print("watching {} files".format(len(analysis.visited)), file=sys.stderr)
+        try:
+            watcher.serve(args.watch_interval, args.socket)
+        except KeyboardInterrupt:
+            pass
+        analysis = watcher.analysis
+    finish(analysis, args, profiler)
+
+if __name__ == "__main__":
+    main()
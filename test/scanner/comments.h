@@ -0,0 +1,14 @@
+// #include "line_comment.h"
+/* #include "block_comment.h" */
+/*
+#include "multiline_comment.h"
+*/
+#include "after_comments.h" // trailing comment
+/* leading */ #include "after_leading_comment.h"
+/* spanning
+   lines */ #include "after_spanning_comment.h"
+#include /* inside */ <inside_comment.h>
+int x; /* a
+#include "hidden_by_comment.h"
+*/ int y;
+#include "last.h"
@@ -0,0 +1,22 @@
+#ifndef CONDITIONALS_H
+#define CONDITIONALS_H
+#pragma once
+#pragma pack(1)
+#if defined(_WIN32) && !defined(/* c */ X) // comment
+#include "windows.h"
+#elif __linux__ >= 1
+#include "linux.h"
+#else
+#include "other.h"
+#endif
+#  ifdef A
+#define B "a // string"
+#  endif
+#ifdefX
+#define F(a) a
+#undef F
+# /* comment */ if defined(COMMENTED)
+#include "after_commented_if.h"
+#/* spanning
+   lines */ endif
+#endif
@@ -0,0 +1,8 @@
+#include "crlf.h"
+#define X \
+  1
+#include "after_crlf_splice.h"
+#if defined(A) /* a comment
+   over two lines */ || defined(B)
+#include "after_crlf_comment.h"
+#endif
@@ -0,0 +1,7 @@
+%:include "digraph.h"
+%:include <digraph_angle.h>
+int a<:2:> = <% 1, 2 %>;
+#include "after_digraphs.h"
+%:ifdef X
+%:include "digraph_conditional.h"
+%:endif
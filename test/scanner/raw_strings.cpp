@@ -0,0 +1,16 @@
+const char* a = R"(
+#include "in_raw_string.h"
+)";
+#include "after_raw_string.h"
+const char* b = R"delim(
+)" #include "in_delimited.h"
+)delim";
+#include "after_delimited.h"
+auto c = u8R"(
+#include "in_prefixed.h"
+)";
+auto d = LR"x(one line)x"; const char* e = "#include \"in_string.h\"";
+char f = '"';
+#include "after_literals.h"
+int g = 1'000'000;
+#include "after_digit_separators.h"
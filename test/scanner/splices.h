@@ -0,0 +1,18 @@
+#define LONG_MACRO(x) \
+    ((x) + 1)
+#include "after_splice.h"
+// a comment continued \
+#include "hidden_by_splice.h"
+#inc\
+lude "spliced_directive.h"
+#include \
+    "spliced_path.h"
+x \
+#include "not_at_line_start.h"
+#include "last.h"
+const char* s = "a string \
+#include \"in_string.h\"";
+#if defined(A) \
+    || defined(B)
+#include "after_spliced_conditional.h"
+#endif
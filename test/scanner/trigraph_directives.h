@@ -0,0 +1,4 @@
+#include "tilde??-.h"
+??=include "after_hash.h"
+#define BRACES ??< ??>
+#include "last.h"
@@ -0,0 +1,4 @@
+??=include "trigraph_hash.h"
+// a comment continued by a trigraph backslash ??/
+#include "hidden_by_trigraph_splice.h"
+#include "after_trigraphs.h"
@@ -0,0 +1,210 @@
+# End to end tests of whole analyses of a small generated project: the different ways of running an
+# analysis have to give the same result. Run from the repository root with python -m unittest discover
+# test (or python -m pytest test).
+import contextlib
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+repository = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, repository)
+import benchmark
+import main
+
+# everything a json report can contain
+sections = ",".join(main.output_sections["json"])
+
+def generate(root: str, seed: int = 1) -> str:
+    # a few dozen headers in layers with some cycles, over two search paths, returns compile_commands.json
+    return benchmark.generate_tree(
+        root, files=60, file_size=200, fanout=3, depth=4, cycle_rate=0.3, search_paths=2, tus=9, seed=seed
+    )
+
+def run(*arguments) -> str:
+    # runs the command line tool, returns its stdout
+    result = subprocess.run(
+        [sys.executable, os.path.join(repository, "main.py"), *arguments],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True
+    )
+    if result.returncode != 0:
+        raise AssertionError("{} failed:\n{}".format(" ".join(arguments), result.stderr))
+    return result.stdout
+
+class GeneratedTreeTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.root = tempfile.mkdtemp(prefix="cpp-dependency-analyzer-test-")
+        cls.compile_commands = generate(cls.root)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.root)
+
+    def report(self, *arguments) -> dict:
+        return json.loads(run("--compile-commands", self.compile_commands, "--format", "json", "--sections", sections, *arguments))
+
+class ShardTest(GeneratedTreeTest):
+    def test_merged_shards_equal_serial(self):
+        serial = self.report()
+        self.assertGreater(len(serial["nodes"]), 60)
+        for count in (1, 2, 4):
+            with self.subTest(shards=count):
+                shards = []
+                for index in range(count):
+                    shards.append(os.path.join(self.root, "shard{}of{}.json".format(index, count)))
+                    run("--compile-commands", self.compile_commands, "--shard", "{}/{}".format(index, count), "--output", shards[-1])
+                # the order of the shard files doesn't matter
+                merged = json.loads(run("merge", *reversed(shards), "--format", "json", "--sections", sections))
+                self.assertEqual(merged, serial)
+
+class ParallelTest(GeneratedTreeTest):
+    def test_jobs_equal_serial(self):
+        for options in ([], ["--fast-scan"], ["--conditionals"]):
+            with self.subTest(options=options):
+                self.assertEqual(self.report("-j", "2", *options), self.report(*options))
+
+def normalized_report(analysis: main.Analysis) -> dict:
+    # the json report with nodes keyed by path, an update numbers new nodes differently than a new analysis
+    out = io.StringIO()
+    main.write_json(analysis, set(main.output_sections["json"]), out)
+    report = json.loads(out.getvalue())
+    paths = [node["path"] for node in report["nodes"]]
+    nodes = {}
+    for node in report["nodes"]:
+        del node["i"]
+        node["dependencies"] = sorted(paths[i] for i in node["dependencies"])
+        node["closure"] = sorted(paths[i] for i in node["closure"])
+        nodes[node["path"]] = node
+    report["nodes"] = nodes
+    report["statistics"]["cycles"] = sorted(sorted(cycle) for cycle in report["statistics"]["cycles"])
+    return report
+
+class UpdateTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="cpp-dependency-analyzer-test-")
+        self.compile_commands = generate(self.root)
+        self.analysis = main.analyze(self.compile_commands)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.root, name)
+
+    def write(self, name: str, text: str):
+        with open(self.path(name), "w") as f:
+            f.write(text)
+
+    def update(self, changed: list) -> int:
+        with contextlib.redirect_stdout(io.StringIO()):
+            return self.analysis.update([self.path(name) for name in changed])
+
+    def assertUpToDate(self):
+        self.assertEqual(normalized_report(self.analysis), normalized_report(main.analyze(self.compile_commands)))
+
+    def test_update_equals_analysis(self):
+        self.analysis.queries()
+        nodes = len(self.analysis.nodes)
+        # everything only reached through these translation units is dropped
+        for t in range(1, 9):
+            self.write("src/t{}.c".format(t), "int main() {}\n")
+        self.update(["src/t{}.c".format(t) for t in range(1, 9)])
+        self.assertLess(len(self.analysis.nodes), nodes - 8)
+        self.assertUpToDate()
+        # and processed again when it's reached again, along with a header which doesn't exist yet
+        self.write("src/t1.c", "#include \"mod1/h1.h\"\n#include \"mod11/h59.h\"\n#include \"missing.h\"\n")
+        self.write("include/p0/mod0/h0.h", "#include \"mod7/h55.h\"\n")
+        self.update(["src/t1.c", "include/p0/mod0/h0.h"])
+        self.assertIn("missing.h", self.analysis.not_found)
+        self.assertUpToDate()
+        # the include is resolved once the header is created
+        self.write("include/p1/missing.h", "#include \"mod0/h0.h\"\n#include \"mod1/h1.h\"\n")
+        self.update([])
+        self.assertIn(self.path("include/p1/missing.h"), self.analysis.nodes)
+        self.assertUpToDate()
+
+    def test_parse_error(self):
+        before = normalized_report(self.analysis)
+        self.write("include/p0/mod0/h0.h", "#include\n")
+        with contextlib.redirect_stderr(io.StringIO()) as stderr:
+            self.update(["include/p0/mod0/h0.h"])
+        self.assertIn("parse error", stderr.getvalue())
+        self.assertEqual(self.analysis.failed, {self.path("include/p0/mod0/h0.h")})
+        self.assertIsNone(self.analysis.previous)
+        # the file keeps its old includes until it can be parsed again
+        self.assertEqual(normalized_report(self.analysis), before)
+        self.write("include/p0/mod0/h0.h", "#include \"mod1/h1.h\"\n")
+        self.update(["include/p0/mod0/h0.h"])
+        self.assertEqual(self.analysis.failed, set())
+        self.assertUpToDate()
+
+def reachable(graph: dict, start: str) -> set:
+    found = {start}
+    stack = [start]
+    while stack:
+        for dependency in graph[stack.pop()]:
+            if dependency not in found:
+                found.add(dependency)
+                stack.append(dependency)
+    return found
+
+class DiffTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="cpp-dependency-analyzer-test-")
+        self.compile_commands = generate(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def snapshot(self, name: str) -> dict:
+        path = os.path.join(self.root, name)
+        main.write_snapshot(main.analyze(self.compile_commands), path)
+        return main.read_snapshot(path)
+
+    def test_diff(self):
+        analysis = main.analyze(self.compile_commands)
+        old = self.snapshot("old.json")
+        graph = {path: node["dependencies"] for path, node in analysis.nodes.items()}
+        includers = {path: [p for p in graph if path in graph[p]] for path in graph}
+        cycles = [{old["labels"][i] for i in cycle} for cycle in old["cycles"]]
+        cyclic = set().union(*cycles)
+        # a header without includes starts to include a header outside of any cycle which includes it
+        leaf, includer = next(
+            (leaf, path) for path in sorted(graph) for leaf in sorted(graph[path])
+            if not graph[leaf] and path not in cyclic and path not in analysis.translation_units
+        )
+        with open(leaf, "a") as f:
+            f.write("#include \"{}\"\n".format("/".join(includer.split(os.sep)[-2:])))
+        # and a translation unit stops including a header which is included elsewhere too
+        unit = os.path.join(self.root, "src", "t0.c")
+        with open(unit) as f:
+            lines = f.readlines()
+        k, removed = next(
+            (k, path) for k, line in enumerate(lines) for path in graph[unit]
+            if line.startswith("#include") and path.endswith("/" + line.split()[1][1:-1]) and len(includers[path]) > 1
+        )
+        with open(unit, "w") as f:
+            f.writelines(lines[:k] + lines[k + 1:])
+        diff = main.diff_snapshots(old, self.snapshot("new.json"))
+
+        self.assertEqual(diff["added_files"], [])
+        self.assertEqual(diff["removed_files"], [])
+        self.assertEqual(diff["added_edges"], [[leaf, includer]])
+        self.assertEqual(diff["removed_edges"], [[unit, removed]])
+        # the new cycle is every file on a path from includer to leaf, it swallows the cycles on those paths
+        cycle = {path for path in reachable(graph, includer) if leaf in reachable(graph, path)}
+        self.assertEqual(diff["new_cycles"], [sorted(cycle)])
+        self.assertEqual(diff["removed_cycles"], sorted(sorted(c) for c in cycles if c <= cycle))
+        self.assertGreater(diff["closure_added"], 0)
+        self.assertTrue(main.diff_grew(diff))
+        # a snapshot doesn't differ from itself
+        same = main.diff_snapshots(old, old)
+        self.assertEqual(same["added_edges"] + same["removed_edges"] + same["new_cycles"] + same["closure"], [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+# Tests of the closure engines against Floyd-Warshall on small random graphs. Run from the repository
+# root with python -m unittest discover test (or python -m pytest test).
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import benchmark
+import main
+
+def floyd_warshall(adjacency: list) -> list:
+    # reference closure, the algorithm build_matrix used originally
+    N = len(adjacency)
+    G = [[0 for _ in range(N)] for _ in range(N)]
+    for i, successors in enumerate(adjacency):
+        for j in successors:
+            G[i][j] = 1
+    for k in range(N):
+        for i in range(N):
+            for j in range(N):
+                G[i][j] = G[i][j] or (G[i][k] and G[k][j])
+    return G
+
+def bits(row: list) -> int:
+    return sum(1 << j for j, reached in enumerate(row) if reached)
+
+class ClosureTest(unittest.TestCase):
+    # (N, degree, cycle rate), without cycles, with a few like real include graphs and with many
+    graphs = [(10, 3, 0.0), (50, 3, 0.01), (50, 2, 0.5), (150, 10, 0.01), (150, 3, 0.2)]
+
+    def test_random_graphs(self):
+        rng = random.Random(0)
+        for N, degree, cycle_rate in self.graphs:
+            adjacency = benchmark.random_graph(N, degree, cycle_rate, rng)
+            expected = [bits(row) for row in floyd_warshall(adjacency)]
+            rows = main.transitive_closure(adjacency)
+            with self.subTest(N=N, degree=degree, cycle_rate=cycle_rate):
+                self.assertEqual(rows, expected)
+                # a small cache so rows are evicted and computed again
+                lazy = main.LazyClosure(main.Graph(adjacency), 1 << 10)
+                for i in rng.sample(range(N), N) + list(range(N)):
+                    self.assertEqual(lazy.row(i), rows[i])
+
+    def test_small_graphs(self):
+        cases = [
+            [],
+            [[]],
+            [[0]],
+            [[1], [0]],
+            [[1], [2], []],
+            [[0, 1], [2], [1], [0]]
+        ]
+        for adjacency in cases:
+            with self.subTest(adjacency=adjacency):
+                expected = [bits(row) for row in floyd_warshall(adjacency)]
+                self.assertEqual(main.transitive_closure(adjacency), expected)
+                lazy = main.LazyClosure(main.Graph(adjacency), 1 << 10)
+                self.assertEqual([lazy.row(i) for i in range(len(adjacency))], expected)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,248 @@
+# Tests of conditional evaluation: #if expressions, include guards and the includes which are active
+# for a translation unit's macros. Run from the repository root with python -m unittest discover test
+# (or python -m pytest test).
+import contextlib
+import io
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import main
+
+def directives(source: str) -> list:
+    with contextlib.redirect_stdout(io.StringIO()):
+        return main.parse_include_directives(main.prepare_source(source))
+
+def parse_result(source: str) -> dict:
+    return main.source_info(directives(source), len(source), source.count("\n"))
+
+def unit_macros(platform: str, command: str = "cc -c a.c") -> dict:
+    # the macros a translation unit compiled with command sees, like Analysis.unit_macros
+    macros = dict(main.platform_macros[platform])
+    macros.update(main.parse_macros(command))
+    return macros
+
+def includes(source: str, platform: str, command: str = "cc -c a.c") -> list:
+    return main.active_includes(parse_result(source), unit_macros(platform, command))
+
+platform_chain = """#if defined(_WIN32)
+#include "windows.h"
+#elif defined(__APPLE__)
+#include "macos.h"
+#elif defined(__linux__)
+#include "linux.h"
+#else
+#include "other.h"
+#endif
+"""
+
+guarded = """#ifndef GUARD_H
+#define GUARD_H
+#ifdef _WIN32
+#include "windows.h"
+#else
+#include "posix.h"
+#endif
+#endif
+"""
+
+class EvaluateConditionTest(unittest.TestCase):
+    def test_literals(self):
+        cases = {
+            "1": 1, "0": 0, "42": 42, "1'000": 1000, "10u": 10, "10ULL": 10, "10lu": 10,
+            "010": 8, "00": 0, "0777": 511,
+            "0x10": 16, "0XfF": 255, "0b101": 5,
+            "'a'": 97, "'\\n'": 10, "'\\0'": 0, "'\\''": 39, "'ab'": None,
+            "true": 1, "false": 0
+        }
+        for expression, value in cases.items():
+            with self.subTest(expression=expression):
+                self.assertEqual(main.evaluate_condition(expression, {}), value)
+
+    def test_operators(self):
+        cases = {
+            "1 + 2 * 3": 7, "(1 + 2) * 3": 9, "-7 / 2": -3, "-7 % 3": -1, "7 % -3": 1, "1 / 0": None,
+            "1 << 4": 16, "1 << 64": None, "~0": -1, "!0": 1, "!5": 0, "3 > 2 && 2 >= 2": 1,
+            "1 == 2 || 2 != 2": 0, "6 & 3 | 8 ^ 1": 11, "1 ? 2 : 3": 2, "0 ? 2 : 3": 3
+        }
+        for expression, value in cases.items():
+            with self.subTest(expression=expression):
+                self.assertEqual(main.evaluate_condition(expression, {}), value)
+
+    def test_unknown_macros(self):
+        macros = {"KNOWN": "1", "UNDEFINED": False, "FUNCTION": None}
+        cases = {
+            "UNKNOWN": None, "UNKNOWN || 1": 1, "UNKNOWN && 0": 0, "UNKNOWN && 1": None, "!UNKNOWN": None,
+            "UNKNOWN ? 2 : 2": 2, "UNKNOWN ? 1 : 2": None, "UNDEFINED": 0, "KNOWN": 1,
+            "defined(UNKNOWN)": None, "defined UNDEFINED": 0, "defined(KNOWN)": 1, "defined FUNCTION": 1,
+            "FUNCTION(1, (2))": None, "__has_include(<vector>)": None, "__has_include(<vector>) || KNOWN": 1
+        }
+        for expression, value in cases.items():
+            with self.subTest(expression=expression):
+                self.assertEqual(main.evaluate_condition(expression, macros), value)
+
+    def test_expansion(self):
+        macros = {"A": "B + 1", "B": "2", "SELF": "SELF + 1", "EMPTY": ""}
+        self.assertEqual(main.evaluate_condition("A == 3", macros), 1)
+        self.assertEqual(main.evaluate_condition("defined(A) && defined B", macros), 1)
+        # a macro isn't expanded inside its own expansion, what's left is unknown
+        self.assertIsNone(main.evaluate_condition("SELF", macros))
+        self.assertIsNone(main.evaluate_condition("EMPTY", macros))
+
+    def test_malformed(self):
+        for expression in ("", "1 +", "(1", "1 2", ")", "defined", "1.5", "\"s\""):
+            with self.subTest(expression=expression):
+                self.assertIsNone(main.evaluate_condition(expression, {}))
+
+    def test_condition_parser(self):
+        parser = main.ConditionParser(main.directive_tokens("1 + 2 * 3 ? 4 : 5 )"), {})
+        self.assertEqual(parser.expression(), 4)
+        self.assertEqual(parser.peek(), ")")
+        for expression in ("1 +", "(1", ")", "1.5"):
+            with self.subTest(expression=expression):
+                with self.assertRaises(ValueError):
+                    main.ConditionParser(main.directive_tokens(expression), {}).expression()
+
+    def test_directive_condition(self):
+        macros = {"A": "1", "B": False}
+        self.assertEqual(main.directive_condition("ifdef", "A", macros), 1)
+        self.assertEqual(main.directive_condition("ifndef", "A", macros), 0)
+        self.assertEqual(main.directive_condition("ifdef", "B", macros), 0)
+        self.assertEqual(main.directive_condition("elifndef", "B", macros), 1)
+        self.assertIsNone(main.directive_condition("elifdef", "C", macros))
+        self.assertEqual(main.directive_condition("elif", "A + 1 == 2", macros), 1)
+
+class IncludeGuardTest(unittest.TestCase):
+    def test_guards(self):
+        cases = {
+            "#ifndef G\n#define G\n#include \"a.h\"\n#endif\n": "G",
+            "#if !defined(G)\n#define G\n#endif\n": "G",
+            "#if !defined G\n#define G 1\n#endif\n": "G",
+            guarded: "GUARD_H",
+            # a nested #if with #else inside the guard
+            "#ifndef G\n#define G\n#if A\n#elif B\n#else\n#endif\n#endif\n": "G"
+        }
+        for source, guard in cases.items():
+            with self.subTest(source=source):
+                self.assertEqual(main.include_guard(directives(source)), guard)
+
+    def test_not_guards(self):
+        cases = [
+            "#ifndef G\n#define H\n#endif\n",
+            "#ifdef G\n#define G\n#endif\n",
+            "#if !defined(G) && X\n#define G\n#endif\n",
+            "#ifndef G\n#define G\n#else\n#include \"a.h\"\n#endif\n",
+            "#ifndef G\n#define G\n#endif\n#include \"after.h\"\n",
+            "#ifndef G\n#define G\n#endif\n#ifndef H\n#define H\n#endif\n",
+            "#include \"before.h\"\n#ifndef G\n#define G\n#endif\n",
+            "#ifndef G\n#endif\n"
+        ]
+        for source in cases:
+            with self.subTest(source=source):
+                self.assertIsNone(main.include_guard(directives(source)))
+
+    def test_source_info(self):
+        # a guard without other conditionals needs no skeleton, every include is always active
+        result = parse_result("#ifndef G\n#define G\n#include \"a.h\"\n#endif\n")
+        self.assertEqual(result["guard"], "G")
+        self.assertIsNone(result["skeleton"])
+        result = parse_result(guarded)
+        self.assertEqual(result["guard"], "GUARD_H")
+        self.assertIsNotNone(result["skeleton"])
+
+class ActiveIncludesTest(unittest.TestCase):
+    def test_elif_chain(self):
+        cases = [
+            ("linux", "cc -c a.c", ["linux.h"]),
+            ("macos", "cc -c a.c", ["macos.h"]),
+            ("windows", "cc -c a.c", ["windows.h"]),
+            ("none", "cc -c a.c", ["windows.h", "macos.h", "linux.h", "other.h"]),
+            ("linux", "cc -U__linux__ -c a.c", ["other.h"]),
+            ("none", "cc -D_WIN32 -c a.c", ["windows.h"]),
+            ("linux", "cc -D__APPLE__=1 -c a.c", ["macos.h"]),
+            # later flags win
+            ("none", "cc -D_WIN32 -U_WIN32 -D__APPLE__ -c a.c", ["macos.h"])
+        ]
+        for platform, command, expected in cases:
+            with self.subTest(platform=platform, command=command):
+                self.assertEqual(includes(platform_chain, platform, command), expected)
+
+    def test_unknown_macro_keeps_both_branches(self):
+        source = "#ifdef FEATURE\n#include \"feature.h\"\n#else\n#include \"fallback.h\"\n#endif\n"
+        self.assertEqual(includes(source, "linux"), ["feature.h", "fallback.h"])
+        self.assertEqual(includes(source, "linux", "cc -DFEATURE -c a.c"), ["feature.h"])
+        self.assertEqual(includes(source, "linux", "cc -UFEATURE -c a.c"), ["fallback.h"])
+        source = "#if FEATURE > 1\n#include \"new.h\"\n#elif FEATURE\n#include \"old.h\"\n#endif\n"
+        self.assertEqual(includes(source, "linux"), ["new.h", "old.h"])
+        self.assertEqual(includes(source, "linux", "cc -DFEATURE=2 -c a.c"), ["new.h"])
+        self.assertEqual(includes(source, "linux", "cc -DFEATURE -c a.c"), ["old.h"])
+        self.assertEqual(includes(source, "linux", "cc -DFEATURE=0 -c a.c"), [])
+
+    def test_define_and_undef(self):
+        source = "#define HAVE_X 1\n#if HAVE_X\n#include \"x.h\"\n#endif\n#undef HAVE_X\n#ifdef HAVE_X\n#include \"y.h\"\n#endif\n"
+        self.assertEqual(includes(source, "none"), ["x.h"])
+        # the file's own #define wins over -D until the file changes it
+        self.assertEqual(includes(source, "none", "cc -DHAVE_X=0 -c a.c"), ["x.h"])
+
+    def test_define_in_unknown_branch(self):
+        source = "#ifdef FEATURE\n#define LEVEL 1\n#endif\n#if LEVEL\n#include \"level.h\"\n#endif\n"
+        # LEVEL may or may not have been redefined
+        self.assertEqual(includes(source, "linux", "cc -DLEVEL=0 -c a.c"), ["level.h"])
+        self.assertEqual(includes(source, "linux", "cc -DFEATURE -DLEVEL=0 -c a.c"), ["level.h"])
+        self.assertEqual(includes(source, "linux", "cc -UFEATURE -DLEVEL=0 -c a.c"), [])
+        # in a dead branch nothing happens
+        source = "#if 0\n#define LEVEL 1\n#endif\n#if LEVEL\n#include \"level.h\"\n#endif\n"
+        self.assertEqual(includes(source, "linux", "cc -DLEVEL=0 -c a.c"), [])
+
+    def test_undef_in_unknown_branch(self):
+        source = "#ifdef FEATURE\n#undef _WIN32\n#endif\n#ifdef _WIN32\n#include \"windows.h\"\n#endif\n"
+        self.assertEqual(includes(source, "windows"), ["windows.h"])
+        self.assertEqual(includes(source, "windows", "cc -DFEATURE -c a.c"), [])
+        self.assertEqual(includes(source, "windows", "cc -UFEATURE -c a.c"), ["windows.h"])
+
+    def test_macros_are_not_changed(self):
+        macros = unit_macros("linux")
+        before = dict(macros)
+        main.active_includes(parse_result("#define A 1\n#undef __linux__\n#ifdef B\n#define C\n#endif\n#include \"a.h\"\n"), macros)
+        self.assertEqual(macros, before)
+
+    def test_guard(self):
+        self.assertEqual(includes(guarded, "linux"), ["posix.h"])
+        self.assertEqual(includes(guarded, "windows"), ["windows.h"])
+        self.assertEqual(includes(guarded, "none"), ["windows.h", "posix.h"])
+        # the guard is always entered, even if the macro is defined on the command line
+        self.assertEqual(includes(guarded, "linux", "cc -DGUARD_H -c a.c"), ["posix.h"])
+        # not a guard: #ifndef around only part of the file
+        source = "#ifndef CONFIG_H\n#define CONFIG_H\n#endif\n#ifdef _WIN32\n#include \"windows.h\"\n#endif\n#include \"common.h\"\n"
+        self.assertEqual(includes(source, "linux"), ["common.h"])
+        self.assertEqual(includes(source, "linux", "cc -DCONFIG_H -c a.c"), ["common.h"])
+
+    def test_nested(self):
+        source = """#ifndef NESTED_H
+#define NESTED_H
+#if defined(_WIN32)
+#  ifdef _WIN64
+    #include "win64.h"
+#  else
+    #include "win32.h"
+#  endif
+#elif UNKNOWN
+  #include "unknown.h"
+#  if 0
+    #include "dead.h"
+#  endif
+#endif
+#include "always.h"
+#endif
+"""
+        self.assertEqual(includes(source, "windows"), ["win64.h", "win32.h", "always.h"])
+        self.assertEqual(includes(source, "windows", "cc -D_WIN64 -c a.c"), ["win64.h", "always.h"])
+        self.assertEqual(includes(source, "linux"), ["unknown.h", "always.h"])
+        self.assertEqual(includes(source, "linux", "cc -DUNKNOWN=0 -c a.c"), ["always.h"])
+
+    def test_unbalanced(self):
+        self.assertEqual(includes("#endif\n#else\n#include \"a.h\"\n", "linux"), ["a.h"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+# Differential tests of the fast directive scanner against the tokenizer-based parser. Run from the
+# repository root with python -m unittest discover test (or python -m pytest test).
+import contextlib
+import io
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import main
+
+fixtures = os.path.join(os.path.dirname(os.path.abspath(__file__)), "scanner")
+
+# (line, path) of the includes each fixture has to produce
+expected_includes = {
+    "comments.h": [
+        (6, "after_comments.h"), (7, "after_leading_comment.h"), (9, "after_spanning_comment.h"),
+        (10, "inside_comment.h"), (14, "last.h")
+    ],
+    "conditionals.h": [(6, "windows.h"), (8, "linux.h"), (10, "other.h"), (19, "after_commented_if.h")],
+    "crlf.h": [(1, "crlf.h"), (4, "after_crlf_splice.h"), (7, "after_crlf_comment.h")],
+    "digraphs.h": [(1, "digraph.h"), (2, "digraph_angle.h"), (4, "after_digraphs.h"), (6, "digraph_conditional.h")],
+    "raw_strings.cpp": [
+        (4, "after_raw_string.h"), (8, "after_delimited.h"), (14, "after_literals.h"), (16, "after_digit_separators.h")
+    ],
+    "splices.h": [
+        (3, "after_splice.h"), (6, "spliced_directive.h"), (8, "spliced_path.h"), (12, "last.h"),
+        (17, "after_spliced_conditional.h")
+    ],
+    "trigraph_directives.h": [(1, "tilde~.h"), (2, "after_hash.h"), (4, "last.h")],
+    "trigraphs.h": [(1, "trigraph_hash.h"), (4, "after_trigraphs.h")]
+}
+
+def read_fixture(name: str) -> bytes:
+    with open(os.path.join(fixtures, name), "rb") as f:
+        return f.read()
+
+def all_directives(data: bytes) -> tuple:
+    # directives found by the parser, the scanner on the prepared str and the scanner on the bytes
+    with contextlib.redirect_stdout(io.StringIO()):
+        content = main.prepare_source(main.decode_source(data, "fixture"))
+        return (
+            main.parse_include_directives(content),
+            main.scan_include_directives(content),
+            main.scan_bytes(data)
+        )
+
+class ScannerTest(unittest.TestCase):
+    def test_fixtures_are_listed(self):
+        self.assertEqual(sorted(os.listdir(fixtures)), sorted(expected_includes))
+
+    def test_parsers_agree(self):
+        for name in expected_includes:
+            with self.subTest(fixture=name):
+                parsed, scanned, scanned_bytes = all_directives(read_fixture(name))
+                self.assertEqual(parsed, scanned)
+                self.assertEqual(parsed, scanned_bytes)
+
+    def test_expected_includes(self):
+        for name, includes in expected_includes.items():
+            with self.subTest(fixture=name):
+                parsed = all_directives(read_fixture(name))[0]
+                self.assertEqual([(line, path) for line, kind, path in parsed if kind == "include"], includes)
+
+    def test_concatenated_fixtures_agree(self):
+        # state from one construct mustn't leak into the next, e.g. line counts after raw strings
+        names = sorted(expected_includes)
+        for order in (names, names[::-1]):
+            data = b"".join(read_fixture(name).rstrip(b"\n") + b"\n" for name in order)
+            parsed, scanned, scanned_bytes = all_directives(data)
+            self.assertEqual(parsed, scanned)
+            self.assertEqual(parsed, scanned_bytes)
+
+    def test_multiline_raw_string_lines(self):
+        parsed, scanned, scanned_bytes = all_directives(b'const char* s = R"(\n)";\n#include "x.h"\n')
+        self.assertEqual(parsed, [(3, "include", "x.h")])
+        self.assertEqual(scanned, parsed)
+        self.assertEqual(scanned_bytes, parsed)
+
+if __name__ == "__main__":
+    unittest.main()